@@ -0,0 +1,841 @@
+"""
+录制脚本的离线压测工具：在本地模拟 B站直播 API，不需要真实直播间即可测量各项指标。
+
+用法：
+    python bench_recorder.py poll --rooms 150 --duration 60
+    python bench_recorder.py framer --messages 100000
+    python bench_recorder.py cmdfilter --messages 200000 --danmu-ratio 0.2
+    python bench_recorder.py detect --rooms 50 --duration 10
+    python bench_recorder.py danmaku --rate 50000 --duration 30
+    python bench_recorder.py store --rows 1000000 --rate 3000
+    python bench_recorder.py layout --comments 1000000 --rate 20000
+    python bench_recorder.py highlight --messages 3000000 --hours 4 --bursts 8   （需要 numpy）
+    python bench_recorder.py reconnect --kind hls --duration 20
+    python bench_recorder.py transcode --seconds 120 --workers 8   （需要 ffmpeg）
+    python bench_recorder.py -o result.json all                    （依次跑上面各项，结果写入 JSON）
+"""
+import os
+import sys
+import json
+import platform
+import zlib
+import struct
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import brotli
+from aiohttp import web
+
+import recorder_id as rec
+
+class MockBiliApi:
+    """本地模拟 B站直播 API：统计每个接口的请求次数，并可按时间表让房间开播"""
+
+    def __init__(self, stream: "FakeStreamSource" = None, danmaku: "MockDanmakuServer" = None):
+        self.live_at = {}         # 房间号 -> 开播时间（monotonic），没有记录表示未开播
+        self.requests = Counter()  # 接口路径 -> 请求次数
+        self.runner = None
+        self.app = web.Application()
+        self.app.router.add_get("/room/v1/Room/get_info", self.get_info)
+        self.app.router.add_get("/room/v1/Room/room_init", self.room_init)
+        self.app.router.add_get("/xlive/web-room/v1/index/getRoomBaseInfo", self.room_base_info)
+        self.app.router.add_get("/xlive/web-room/v2/index/getRoomPlayInfo", self.room_play_info)
+        self.app.router.add_get("/xlive/web-room/v1/index/getDanmuInfo", self.danmu_info)
+        self.stream = stream or FakeStreamSource()
+        self.stream.register(self.app)
+        self.danmaku = danmaku or MockDanmakuServer(rate=None)
+        self.danmaku.register(self.app, self.live_status)
+        self.base = ""
+
+    def live_status(self, rid: str) -> int:
+        """房间当前的直播状态：1 直播中，0 未开播"""
+        at = self.live_at.get(rid)
+        return 1 if at is not None and time.monotonic() >= at else 0
+
+    async def get_info(self, request):
+        rid = request.query["room_id"]
+        self.requests[request.path] += 1
+        return web.json_response({"code": 0, "data": {
+            "room_id": int(rid), "live_status": self.live_status(rid), "title": f"测试直播{rid}"}})
+
+    async def room_init(self, request):
+        rid = request.query["id"]
+        self.requests[request.path] += 1
+        return web.json_response({"code": 0, "data": {"room_id": int(rid), "live_status": self.live_status(rid)}})
+
+    async def room_base_info(self, request):
+        rids = request.query.getall("room_ids", [])
+        self.requests[request.path] += 1
+        return web.json_response({"code": 0, "data": {"by_room_ids": {
+            rid: {"room_id": int(rid), "live_status": self.live_status(rid)} for rid in rids}}})
+
+    async def room_play_info(self, request):
+        """返回指向本地假直播源的播放地址，格式与线上 playurl_info 一致"""
+        self.requests[request.path] += 1
+        if self.stream.kind == "flv":
+            protocol, fmt, base_url = "http_stream", "flv", "/live/stream.flv"
+        else:
+            protocol, fmt, base_url = "http_hls", "ts", "/live/index.m3u8"
+        codec = {"codec_name": "avc", "base_url": base_url, "url_info": [{"host": self.base, "extra": "?bench=1"}]}
+        return web.json_response({"code": 0, "data": {"playurl_info": {"playurl": {"stream": [
+            {"protocol_name": protocol, "format": [{"format_name": fmt, "codec": [codec]}]}]}}}})
+
+    async def danmu_info(self, request):
+        """弹幕服务器接入点指向本地模拟的 /sub（recorder_id.danmu_ws_scheme 需设为 "ws"）"""
+        self.requests[request.path] += 1
+        host, port = self.runner.addresses[0][:2]
+        return web.json_response({"code": 0, "data": {"token": "bench", "host_list": [
+            {"host": host, "port": port, "ws_port": port, "wss_port": port}]}})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """启动服务，返回可直接赋给 recorder_id.api_base 的地址"""
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        host, port = self.runner.addresses[0][:2]
+        self.base = f"http://{host}:{port}"
+        return self.base
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+class FakeStreamSource:
+    """本地假直播源：HLS 滚动播放列表和 HTTP-FLV 长连接，每隔 drop_every 秒断开一次模拟 CDN 断线"""
+
+    def __init__(self, kind: str = "hls", segment_bytes: int = 256 * 1024,
+                 segment_duration: float = 0.25, drop_every: float = 5.0):
+        self.kind = kind
+        self.segment_bytes = segment_bytes
+        self.segment_duration = segment_duration
+        self.drop_every = drop_every
+        self.started = time.monotonic()
+        self.last_drop = self.started
+        self.drops = 0
+
+    def register(self, app: web.Application):
+        app.router.add_get("/live/index.m3u8", self.playlist)
+        app.router.add_get("/live/{seq}.ts", self.segment)
+        app.router.add_get("/live/stream.flv", self.flv)
+
+    def should_drop(self) -> bool:
+        """距上次断开已超过 drop_every 秒时断开一次"""
+        now = time.monotonic()
+        if now - self.last_drop >= self.drop_every:
+            self.last_drop = now
+            self.drops += 1
+            return True
+        return False
+
+    async def playlist(self, request):
+        if self.should_drop():
+            raise web.HTTPServiceUnavailable()
+        head = int((time.monotonic() - self.started) / self.segment_duration)
+        first = max(0, head - 3)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+                 f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for n in range(first, head + 1):
+            lines += [f"#EXTINF:{self.segment_duration},", f"{n}.ts"]
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+
+    async def segment(self, request):
+        return web.Response(body=bytes(self.segment_bytes), content_type="video/mp2t")
+
+    async def flv(self, request):
+        resp = web.StreamResponse(headers={"Content-Type": "video/x-flv"})
+        await resp.prepare(request)
+        chunk = bytes(self.segment_bytes)
+        self.last_drop = time.monotonic()
+        while not self.should_drop():
+            await resp.write(chunk)
+            await asyncio.sleep(self.segment_duration)
+        return resp  # 正常结束响应，相当于 CDN 主动断开
+
+class MockDanmakuServer:
+    """
+    本地模拟弹幕服务器（/sub）：完成认证、回复心跳，房间开播时推送 LIVE，
+    并按 rate（条/分钟）推送 DANMU_MSG，每条 WebSocket 消息打包 batch 条，协议版本在 vers 中轮换。
+    rate 为 None 时不推送弹幕，为 0 时不限速；replay 为 JSONL 文件（每行一条命令）时回放其中的命令。
+    drop_every 大于 0 时每条连接存活这么多秒后由服务端断开，统计客户端重连的断档。
+    与被测代码共用一个事件循环，不限速时测得的是两者合计的上限。
+    """
+
+    def __init__(self, rate: float = None, batch: int = 20, vers: tuple = (0, 2, 3),
+                 drop_every: float = 0, replay: str = None):
+        self.rate = rate
+        self.batch = batch
+        self.vers = vers
+        self.drop_every = drop_every
+        self.sending = True
+        self.sent = Counter()        # 房间号 -> 已推送弹幕条数
+        self.connects = Counter()    # 房间号 -> 认证成功的连接数
+        self.closed_at = {}          # 房间号 -> 服务端最近一次断开的时间
+        self.reconnect_gaps = []     # 断开到客户端重新认证的时长（秒）
+        self.first_sent_at = None
+        cmds = [json.loads(line) for line in Path(replay).read_text(encoding="utf-8").splitlines() if line.strip()] \
+            if replay else [make_danmu_cmd(i) for i in range(batch * 64)]
+        # 预先打包好一批消息循环发送，避免压缩开销挤占被测代码的 CPU
+        self.payloads = []
+        if rate is not None:
+            for i in range(0, len(cmds), batch):
+                chunk = cmds[i:i + batch]
+                self.payloads.append((make_ws_message(chunk, vers[len(self.payloads) % len(vers)]),
+                                      sum(1 for c in chunk if c.get("cmd") == "DANMU_MSG")))
+
+    def register(self, app: web.Application, live_status):
+        self.live_status = live_status
+        app.router.add_get("/sub", self.handle)
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        auth = await ws.receive()
+        if auth.type != web.WSMsgType.BINARY:
+            return ws
+        rid = str(json.loads(auth.data[16:])["roomid"])
+        self.connects[rid] += 1
+        if rid in self.closed_at:
+            self.reconnect_gaps.append(time.monotonic() - self.closed_at.pop(rid))
+        await ws.send_bytes(pack_frame(8, 1, b'{"code":0}'))
+        pump = asyncio.create_task(self.pump(ws, rid))
+        try:
+            async for msg in ws:
+                if msg.type == web.WSMsgType.BINARY and struct.unpack_from(">I", msg.data, 8)[0] == 2:
+                    await ws.send_bytes(pack_frame(3, 1, struct.pack(">I", 1)))  # 心跳回复（人气值）
+        finally:
+            pump.cancel()
+        return ws
+
+    async def pump(self, ws, rid: str):
+        """按开播状态推送 LIVE，按速率推送弹幕，到时间后断开连接"""
+        connected = time.monotonic()
+        announced = self.live_status(rid) == 1  # 连接时已开播则不再推送 LIVE
+        interval = self.batch * 60 / self.rate if self.rate else 0
+        next_send = time.monotonic()
+        n = 0
+        while not ws.closed:
+            now = time.monotonic()
+            if self.drop_every and now - connected >= self.drop_every:
+                self.closed_at[rid] = now
+                await ws.close()
+                return
+            if not announced and self.live_status(rid) == 1:
+                announced = True
+                await ws.send_bytes(pack_frame(5, 0, json.dumps({"cmd": "LIVE", "roomid": int(rid)}).encode()))
+            if not self.payloads or not self.sending:
+                await asyncio.sleep(0.02)
+                continue
+            payload, count = self.payloads[n % len(self.payloads)]
+            n += 1
+            if self.first_sent_at is None:
+                self.first_sent_at = now
+            await ws.send_bytes(payload)
+            self.sent[rid] += count
+            if interval:
+                next_send += interval
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+            else:
+                await asyncio.sleep(0)  # 不限速时也让出事件循环，否则接收端永远轮不到
+
+def setup_workdir(name: str) -> Path:
+    """为压测准备临时保存目录和 Cookie 文件，避免读写用户配置的目录"""
+    workdir = Path(tempfile.mkdtemp(prefix=f"bench_{name}_"))
+    (workdir / "cookies.txt").write_text("SESSDATA=bench", encoding="utf-8")
+    rec.save_dir = str(workdir)
+    rec.cookie_file = str(workdir / "cookies.txt")
+    return workdir
+
+def reset_recorder(base: str):
+    """把录制脚本指向本地模拟服务，并清掉上一项压测留下的缓存和全局状态"""
+    rec.api_base = base
+    rec.danmu_ws_scheme = "ws"
+    rec.api_client.cache.clear()
+    rec._host_buckets.clear()
+    rec._live_poller = None
+
+def percentile(values: list, q: float) -> float:
+    """简单分位数（最近秩），values 为空时返回 0"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def bench_poll(rooms: int, duration: float, live_ratio: float, interval: float) -> dict:
+    """HTTP 轮询压测：一部分房间在随机时刻开播，统计请求数和开播检测延迟"""
+    api = MockBiliApi()
+    reset_recorder(await api.start())
+    setup_workdir("poll")
+    rec.check_interval = interval
+    rec.poll_min_interval = interval / 2
+    rec.api_rate_limit = 50
+
+    rids = [str(100000 + i) for i in range(rooms)]
+    t0 = time.monotonic()
+    for rid in random.sample(rids, int(rooms * live_ratio)):
+        api.live_at[rid] = t0 + random.uniform(0, duration * 0.8)
+
+    poller = rec.get_live_poller()
+    latencies = []
+
+    async def watch(rid):
+        await poller.wait_live(rid)
+        latencies.append(time.monotonic() - api.live_at[rid])
+
+    tasks = [asyncio.create_task(watch(rid)) for rid in rids]
+    await asyncio.sleep(duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await api.stop()
+
+    return {
+        "rooms": rooms,
+        "duration_s": duration,
+        "went_live": len(api.live_at),
+        "detected": len(latencies),
+        "requests": sum(api.requests.values()),
+        # 改造前每个房间每 check_interval 秒单独请求一次
+        "requests_per_room_polling": int(rooms * duration / interval),
+        "latency_mean_s": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        "latency_p95_s": round(percentile(latencies, 0.95), 3),
+        "latency_max_s": round(max(latencies, default=0.0), 3),
+    }
+
+async def bench_reconnect(kind: str, duration: float, drop_every: float) -> dict:
+    """进程内拉流断线续录压测：假直播源定时断开，统计每次续录的断档时长（含直播源自身的出片间隔）"""
+    api = MockBiliApi(FakeStreamSource(kind=kind, drop_every=drop_every))
+    reset_recorder(await api.start())
+    workdir = setup_workdir("reconnect")
+    fetcher = rec.NativeFetcher("1")
+    segments = []
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        path = await fetcher.fetch_segment(workdir / f"seg{len(segments):04d}")
+        if path is not None:
+            segments.append(path)
+    await rec.close_http_session()
+    await api.stop()
+    gaps = fetcher.gaps
+    return {
+        "kind": kind,
+        "duration_s": duration,
+        "drops": api.stream.drops,
+        "segments": len(segments),
+        "bytes": sum(p.stat().st_size for p in segments),
+        "gap_mean_s": round(sum(gaps) / len(gaps), 3) if gaps else 0.0,
+        "gap_p95_s": round(percentile(gaps, 0.95), 3),
+        "gap_max_s": round(max(gaps, default=0.0), 3),
+    }
+
+async def bench_detect(rooms: int, duration: float, live_ratio: float) -> dict:
+    """WebSocket 开播检测压测：每个房间一条常驻弹幕连接等待 LIVE，统计从开播到 wait_for_live 返回的延迟"""
+    api = MockBiliApi()
+    reset_recorder(await api.start())
+    setup_workdir("detect")
+    rids = [str(200000 + i) for i in range(rooms)]
+    t0 = time.monotonic()
+    for rid in random.sample(rids, int(rooms * live_ratio)):
+        api.live_at[rid] = t0 + random.uniform(1, duration * 0.8)
+    latencies = []
+
+    async def watch(rid):
+        conn = rec.RoomEventConnection(rid).start()
+        try:
+            await rec.wait_for_live(rec.Room(rid, "", rid), conn)
+            latencies.append(time.monotonic() - api.live_at[rid])
+        finally:
+            await conn.close()
+
+    tasks = [asyncio.create_task(watch(rid)) for rid in rids]
+    await asyncio.sleep(duration)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await rec.close_http_session()
+    await api.stop()
+    return {
+        "rooms": rooms,
+        "duration_s": duration,
+        "went_live": len(api.live_at),
+        "detected": len(latencies),
+        "ws_connects": sum(api.danmaku.connects.values()),
+        "latency_mean_s": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        "latency_p95_s": round(percentile(latencies, 0.95), 4),
+        "latency_max_s": round(max(latencies, default=0.0), 4),
+    }
+
+async def bench_danmaku(rate: float, duration: float, batch: int, vers: tuple,
+                        drop_every: float, replay: str = None) -> dict:
+    """
+    弹幕端到端压测：模拟弹幕服务器按 rate（条/分钟，0 为不限速）推送，经 danmu_listener 分帧、解析后进入写盘队列，
+    统计推送 / 收到条数、吞吐、每千条 CPU 时间、停止推送后追平所需时间，以及服务端断开后的重连断档。
+    """
+    danmaku = MockDanmakuServer(rate=rate, batch=batch, vers=vers, drop_every=drop_every, replay=replay)
+    api = MockBiliApi(danmaku=danmaku)
+    reset_recorder(await api.start())
+    workdir = setup_workdir("danmaku")
+    writer = rec.DanmakuWriter(workdir / "danmaku.db")
+    writer.start()
+    stop = asyncio.Event()
+    ingest_key = rec.Metrics.key("recorder_danmaku_ingest_total", {"room": "1"})
+    baseline = rec.metrics.counters.get(ingest_key, 0)
+
+    def received() -> int:
+        """danmu_listener 已解析并交给写盘队列的条数（取自运行指标）"""
+        return rec.metrics.counters.get(ingest_key, 0) - baseline
+
+    cpu0 = time.process_time()
+    listener = asyncio.create_task(rec.danmu_listener("1", writer, datetime.now(), stop))
+    await asyncio.sleep(duration)
+    danmaku.sending = False
+    stopped = time.monotonic()
+    # 停止推送后等接收端把已发出的弹幕处理完
+    while received() < danmaku.sent["1"] and time.monotonic() - stopped < 10:
+        await asyncio.sleep(0.01)
+    drained = time.monotonic()
+    cpu = time.process_time() - cpu0
+    stop.set()
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
+    await asyncio.to_thread(writer.close)
+    await rec.close_http_session()
+    await api.stop()
+
+    got = received()
+    elapsed = drained - (danmaku.first_sent_at or stopped)
+    gaps = danmaku.reconnect_gaps
+    return {
+        "rate_per_min": rate,
+        "batch": batch,
+        "vers": list(vers),
+        "duration_s": duration,
+        "sent": danmaku.sent["1"],
+        "received": got,
+        "written": writer.written,
+        "dropped": writer.dropped,
+        "msgs_per_s": round(got / elapsed) if elapsed > 0 else 0,
+        "cpu_ms_per_1k": round(cpu * 1000 / got * 1000, 2) if got else None,
+        "drain_s": round(drained - stopped, 3),
+        "ws_connects": danmaku.connects["1"],
+        "reconnect_gap_mean_s": round(sum(gaps) / len(gaps), 3) if gaps else 0.0,
+        "reconnect_gap_max_s": round(max(gaps, default=0.0), 3),
+    }
+
+def bench_store(rows: int, rate: float, clip_s: float) -> dict:
+    """弹幕库压测：写库线程的写入吞吐、按时间段导出片段弹幕、整场导出 ASS、全文搜索的耗时"""
+    workdir = setup_workdir("store")
+    session = workdir / "session"
+    session.mkdir()
+    db = session / "danmaku.db"
+    step_ms = 60000 / rate  # 按 rate 条/分钟摊开时间
+    writer = rec.DanmakuWriter(db, {"room": "1"})
+    writer.start()
+    t0 = time.perf_counter()
+    for i in range(rows):
+        row = rec.danmaku_row(make_danmu_cmd(i), int(i * step_ms))
+        while not writer.put(row):
+            time.sleep(0.001)  # 队列满时等写库线程追上，测的是写库线程的吞吐
+    writer.close(timeout=600)
+    insert_s = time.perf_counter() - t0
+    span_s = rows * step_ms / 1000
+
+    t0 = time.perf_counter()
+    clipped = rec.export_danmaku(db, workdir / "clip.ass", "ass", span_s / 2, span_s / 2 + clip_s)
+    clip_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    exported = rec.export_danmaku(db, workdir / "full.ass", "ass")
+    full_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    found = len(rec.search_danmaku("测试弹幕 42 ", root=str(workdir), limit=10 ** 9))
+    search_ms = (time.perf_counter() - t0) * 1000
+    return {
+        "rows": rows,
+        "span_h": round(span_s / 3600, 2),
+        "insert_rows_per_s": round(rows / insert_s),
+        "db_mb": round(db.stat().st_size / 1e6, 1),
+        "clip_s": clip_s,
+        "clip_rows": clipped,
+        "clip_export_ms": round(clip_ms, 1),
+        "full_export_rows": exported,
+        "full_export_s": round(full_s, 2),
+        "search_hits": found,
+        "search_ms": round(search_ms, 1),
+    }
+
+def bench_highlight(messages: int, hours: float, bursts: int) -> dict:
+    """
+    高光检测压测：合成一场弹幕库（平时速率缓慢起伏，其中一小时整体偏高，另外注入 bursts 段 20 秒的突增），
+    测量读库、向量化打分、选峰的耗时，以及注入的突增被选中的比例。
+    """
+    np = rec.np
+    if np is None:
+        raise SystemExit("需要安装 numpy")
+    workdir = setup_workdir("highlight")
+    db = workdir / "danmaku.db"
+    rng = np.random.default_rng(7)
+    span = int(hours * 3600)
+    sec = np.arange(span)
+    base = 1 + 0.5 * np.sin(sec / 900) + ((sec > span / 3) & (sec < span / 3 + 3600))  # 一小时整体更热闹，不算突增
+    starts = np.sort(rng.choice(np.arange(600, span - 600, 600), bursts, replace=False))
+    for st in starts:
+        base[st:st + 20] *= 6
+    counts = rng.poisson(base * messages / base.sum())
+    ts_ms = (np.repeat(sec, counts) + rng.random(counts.sum())) * 1000
+    store = rec.DanmakuStore(db)
+    t0 = time.perf_counter()
+    for i in range(0, len(ts_ms), 200000):
+        store.append([(int(t), 1, "u", "DANMU_MSG", "哈", 16777215, 1) for t in ts_ms[i:i + 200000]])
+    store.close()
+    insert_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    times = rec.load_danmaku_times(db)
+    t1 = time.perf_counter()
+    rate, score = rec.burst_scores(times, rec.highlight_window, rec.highlight_baseline)
+    peaks = rec.pick_peaks(score, bursts, int(rec.highlight_separation), rec.highlight_min_score)
+    t2 = time.perf_counter()
+    hit = sum(any(p - rec.highlight_window < st < p + rec.highlight_window for p in peaks) for st in starts)
+    return {
+        "messages": int(len(times)),
+        "hours": hours,
+        "insert_s": round(insert_s, 2),
+        "load_s": round(t1 - t0, 2),
+        "score_s": round(t2 - t1, 3),
+        "total_s": round(t2 - t0, 2),
+        "bursts": bursts,
+        "bursts_found": hit,
+        "peaks_s": sorted(peaks),
+        "bursts_s": [int(st) for st in starts],
+    }
+
+PHRASES = ["哈哈哈哈", "草", "awsl", "前方高能", "？？？", "好耶", "8888888", "来了来了", "太强了", "xswl"]
+
+def make_dense_feed(count: int, rate: float, dup_ratio: float):
+    """合成密集弹幕：rate 条/分钟均匀分布，dup_ratio 比例为刷屏短语，其余各不相同；少量顶部 / 底部和彩色弹幕"""
+    rng = random.Random(42)
+    step = 60 / rate
+    for i in range(count):
+        if rng.random() < dup_ratio:
+            text = rng.choice(PHRASES)
+        else:
+            text = f"测试弹幕{i} " + "哈" * rng.randint(0, 12)
+        r = rng.random()
+        mode = 5 if r < 0.03 else 4 if r < 0.06 else 1
+        color = 0xFFFFFF if rng.random() < 0.9 else rng.randrange(0xFFFFFF)
+        yield i * step, text, color, mode
+
+def count_overlaps(lines: list, sample: int = 20000) -> int:
+    """
+    抽查同一轨道上相邻的两条滚动弹幕：后一条出现时前一条的尾部应已完全进入画面
+    （匀速移动，之后不会追尾）。ASS 时间精确到百分秒，留 0.02 秒误差。
+    """
+    tail_in = {}  # 轨道 y -> 上一条尾部完全进入画面的时间
+    overlaps = 0
+    for line in lines[:sample]:
+        fields = line.split(",", 9)
+        m = rec.MOVE_RE.search(fields[9])
+        if not m:
+            continue
+        start, end = rec.parse_ass_time(fields[1]), rec.parse_ass_time(fields[2])
+        x1, y, x2 = int(m[1]), int(m[2]), int(m[3])
+        if y in tail_in and start < tail_in[y] - 0.02:
+            overlaps += 1
+        tail_in[y] = start + -x2 * (end - start) / (x1 - x2)
+    return overlaps
+
+def bench_layout(count: int, rate: float, dup_ratio: float) -> dict:
+    """弹幕排布压测：合成密集弹幕，比较旧版逐条写 Dialogue 与轨道排布的耗时、输出条数，并抽查追尾"""
+    t0 = time.perf_counter()
+    legacy = sum(1 for t, text, _, _ in make_dense_feed(count, rate, dup_ratio)
+                 if rec.format_dialogue(text, timedelta(seconds=t)))
+    legacy_s = time.perf_counter() - t0
+    layout = rec.DanmakuLayout()
+    t0 = time.perf_counter()
+    lines = list(layout.layout(make_dense_feed(count, rate, dup_ratio)))
+    layout_s = time.perf_counter() - t0
+    return {
+        "comments": count,
+        "rate_per_min": rate,
+        "dup_ratio": dup_ratio,
+        "tracks": layout.tracks,
+        "legacy_s": round(legacy_s, 2),
+        "legacy_lines": legacy,
+        "layout_s": round(layout_s, 2),
+        "layout_comments_per_s": round(count / layout_s),
+        "placed": layout.placed,
+        "merged": layout.merged,
+        "dropped": layout.dropped,
+        "overlaps_in_sample": count_overlaps(lines),
+    }
+
+async def bench_transcode(seconds: int, workers: int, chunk_seconds: int) -> dict:
+    """带弹幕压制：合成一段测试视频和弹幕，比较单个 ffmpeg 与分段并行压制的耗时"""
+    if shutil.which("ffmpeg") is None:
+        raise SystemExit("❌ 未找到 ffmpeg，无法运行 transcode 压测")
+    workdir = setup_workdir("transcode")
+    src = workdir / "src.ts"
+    returncode, _ = await rec.run_ffmpeg([
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", "60", "-c:a", "aac", "-f", "mpegts", str(src)
+    ])
+    if returncode != 0:
+        raise SystemExit("❌ 生成测试视频失败")
+    danmaku = workdir / "danmaku.ass"
+    rec.write_ass_header(danmaku)
+    with danmaku.open("a", encoding="utf-8") as f:
+        for i in range(seconds * 20):  # 每秒 20 条弹幕
+            f.write(rec.format_dialogue(f"测试弹幕 {i}", timedelta(seconds=i / 20)))
+
+    burn = f"subtitles=filename={rec.ffmpeg_filter_path(danmaku)}"
+    returncode, single = await rec.run_ffmpeg([
+        "-i", str(src), "-filter_complex", f"[0:v]{burn}[danmu]", "-map", "[danmu]", "-map", "0:a?",
+        "-c:v", "libx264", "-c:a", "aac", str(workdir / "single.mp4")
+    ])
+    rec.parallel_chunk_seconds = chunk_seconds
+    ok, parallel = await rec.encode_with_danmu_parallel(src, danmaku, workdir / "parallel.mp4", workers)
+    return {
+        "seconds": seconds,
+        "workers": workers,
+        "chunk_seconds": chunk_seconds,
+        "single": {**single, "ok": returncode == 0},
+        "parallel": {**parallel, "ok": ok},
+        "speedup": round(single["wall_s"] / parallel["wall_s"], 2) if parallel["wall_s"] else None,
+    }
+
+def legacy_parse_ws_slices(blob: bytes) -> list:
+    """改造前的 parse_ws_slices（逐字段切片 + 递归），仅作为压测基线"""
+    results = []
+    offset = 0
+    while offset + 16 <= len(blob):
+        packet_len = int.from_bytes(blob[offset:offset+4], "big")
+        header_len = int.from_bytes(blob[offset+4:offset+6], "big")
+        ver = int.from_bytes(blob[offset+6:offset+8], "big")
+        op = int.from_bytes(blob[offset+8:offset+12], "big")
+        body = blob[offset + header_len: offset + packet_len]
+        if op == 5:
+            if ver in (2, 3):
+                try:
+                    if ver == 2:
+                        body = zlib.decompress(body)
+                    else:
+                        body = brotli.decompress(body)
+                except Exception:
+                    pass
+                results.extend(legacy_parse_ws_slices(body))
+            else:
+                try:
+                    results.append(json.loads(body.decode("utf-8", errors="ignore")))
+                except Exception:
+                    pass
+        offset += packet_len
+    return results
+
+def pack_frame(op: int, ver: int, body: bytes) -> bytes:
+    """按弹幕协议封包，可指定协议版本（0 原始 JSON，2 zlib，3 brotli）"""
+    return struct.pack(">IHHII", 16 + len(body), 16, ver, op, 1) + body
+
+def make_danmu_cmd(i: int) -> dict:
+    """构造一条与线上格式一致的 DANMU_MSG 命令"""
+    return {"cmd": "DANMU_MSG", "info": [
+        [0, 1, 25, 16777215, int(time.time() * 1000), 0, 0, f"{i:08x}", 0, 0, 0, "", 0, "{}", "{}"],
+        f"测试弹幕 {i % 500} 哈哈哈",
+        [10000 + i % 3000, f"用户{i % 3000}", 0, 0, 0, 10000, 1, ""],
+        [], [0, 0, 9868950, ">50000", 0], ["", ""], 0, 0, None, {"ts": int(time.time()), "ct": "0"}, 0, 0]}
+
+def make_noise_cmd(i: int) -> dict:
+    """构造大房间里占多数、录制用不到的命令：进场、在线榜、看过人数、进场特效"""
+    kind = i % 4
+    if kind == 0:
+        return {"cmd": "INTERACT_WORD", "data": {
+            "uid": 10000 + i % 5000, "uname": f"用户{i % 5000}", "msg_type": 1, "roomid": 299, "timestamp": int(time.time()),
+            "fans_medal": {"medal_level": i % 30, "medal_name": "粉丝团", "target_id": 1, "medal_color": 6067854},
+            "identities": [1], "trigger_time": time.time_ns(), "uinfo": {"uid": 10000 + i % 5000, "base": {
+                "name": f"用户{i % 5000}", "face": "https://i0.hdslb.com/bfs/face/member/noface.jpg"}}}}
+    if kind == 1:
+        return {"cmd": "ONLINE_RANK_COUNT", "data": {"count": 12345 + i, "count_text": "1万+", "online_count": 23456}}
+    if kind == 2:
+        return {"cmd": "WATCHED_CHANGE", "data": {"num": 100000 + i, "text_small": "10万", "text_large": "10万人看过"}}
+    return {"cmd": "ENTRY_EFFECT", "data": {"id": 4, "uid": 10000 + i % 5000, "target_id": 1, "mock_effect": 0,
+                                            "copy_writing": f"欢迎 <%用户{i % 5000}%> 进入直播间", "priority": 1}}
+
+def make_ws_message(cmds: list, ver: int) -> bytes:
+    """把若干命令打成一条 WebSocket 消息：ver 0 为多个原始包相连，ver 2/3 为整体压缩"""
+    inner = b"".join(pack_frame(5, 0, json.dumps(c, ensure_ascii=False).encode()) for c in cmds)
+    if ver == 2:
+        return pack_frame(5, 2, zlib.compress(inner))
+    if ver == 3:
+        return pack_frame(5, 3, brotli.compress(inner, quality=5))
+    return inner
+
+def bench_framer(messages: int, batch: int) -> dict:
+    """分帧压测：同一批合成的 ver 0/2/3 数据，比较旧 parse_ws_slices 与 DanmakuFramer 的吞吐"""
+    result = {"messages": messages, "batch": batch}
+    for ver in (0, 2, 3):
+        payloads = [make_ws_message([make_danmu_cmd(i + j) for j in range(batch)], ver)
+                    for i in range(0, messages, batch)]
+        t0 = time.perf_counter()
+        legacy = sum(len(legacy_parse_ws_slices(p)) for p in payloads)
+        t1 = time.perf_counter()
+        framer = rec.DanmakuFramer()
+        framed = sum(1 for p in payloads for _ in framer.feed(p))
+        t2 = time.perf_counter()
+        assert legacy == framed, (legacy, framed)
+        result[f"ver{ver}"] = {
+            "legacy_msgs_per_s": round(legacy / (t1 - t0)),
+            "framer_msgs_per_s": round(framed / (t2 - t1)),
+            "speedup": round((t1 - t0) / (t2 - t1), 2),
+        }
+    return result
+
+def bench_cmd_filter(messages: int, batch: int, danmu_ratio: float) -> dict:
+    """
+    按 cmd 过滤解析的吞吐：合成大房间的命令混合（少量弹幕，大量进场、在线榜等），
+    比较全部解析、按录制订阅的 cmd 过滤（标准库 json / orjson）三种方式。
+    """
+    rng = random.Random(1)
+    cmds = []
+    for i in range(messages):
+        if rng.random() < danmu_ratio:
+            cmd = make_danmu_cmd(i)
+            if i % 2:
+                cmd["cmd"] = "DANMU_MSG:4:0:2:2:2:0"  # 线上部分弹幕带后缀
+            cmds.append(cmd)
+        else:
+            cmds.append(make_noise_cmd(i))
+    wanted = set(rec.DANMAKU_CMDS) | {"LIVE", "PREPARING"}
+    expected = sum(1 for c in cmds if c["cmd"].partition(":")[0] in wanted)
+    result = {"messages": messages, "batch": batch, "danmu_ratio": danmu_ratio, "wanted": expected,
+              "orjson": rec.orjson is not None}
+    backend = rec.orjson
+    modes = [("full_json", None, None), ("filtered_json", wanted, None)]
+    if backend is not None:
+        modes.append(("filtered_orjson", wanted, backend))
+    try:
+        for ver in (0, 2):
+            payloads = [make_ws_message(cmds[i:i + batch], ver) for i in range(0, messages, batch)]
+            row = {}
+            for name, want, rec.orjson in modes:
+                framer = rec.DanmakuFramer()
+                t0 = time.perf_counter()
+                got = sum(1 for p in payloads for c in framer.feed(p, want) if c["cmd"].partition(":")[0] in wanted)
+                elapsed = time.perf_counter() - t0
+                assert got == expected, (name, got, expected)
+                row[name] = {"msgs_per_s": round(messages / elapsed), "parsed": framer.parsed, "skipped": framer.skipped}
+            row["speedup"] = round(row["full_json"]["msgs_per_s"] and
+                                   row[modes[-1][0]]["msgs_per_s"] / row["full_json"]["msgs_per_s"], 2)
+            result[f"ver{ver}"] = row
+    finally:
+        rec.orjson = backend
+    return result
+
+async def bench_all(with_transcode: bool) -> dict:
+    """依次运行各项压测（参数取较短的默认值），汇总成一份便于对比回归的结果"""
+    result = {"meta": {"time": datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "cpu_count": os.cpu_count()}}
+    result["framer"] = bench_framer(50000, 20)
+    result["cmd_filter"] = bench_cmd_filter(200000, 20, 0.2)
+    result["poll"] = await bench_poll(150, 20, 0.2, 2)
+    result["detect"] = await bench_detect(50, 10, 0.5)
+    result["danmaku_50k_per_min"] = await bench_danmaku(50000, 20, 20, (0, 2, 3), 0)
+    result["danmaku_unlimited"] = await bench_danmaku(0, 10, 20, (0, 2, 3), 0)
+    result["danmaku_reconnect"] = await bench_danmaku(50000, 20, 20, (2,), 4)
+    result["store"] = await asyncio.to_thread(bench_store, 200000, 3000, 600)
+    result["layout"] = bench_layout(1000000, 20000, 0.3)
+    if rec.np is not None:
+        result["highlight"] = bench_highlight(1000000, 4, 8)
+    result["reconnect_hls"] = await bench_reconnect("hls", 12, 4)
+    result["reconnect_flv"] = await bench_reconnect("flv", 12, 4)
+    if with_transcode:
+        result["transcode"] = await bench_transcode(60, os.cpu_count() or 4, 15)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="录制脚本离线压测")
+    parser.add_argument("-o", "--output", help="把结果写入 JSON 文件")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("poll", help="批量 HTTP 轮询：请求数与开播检测延迟")
+    p.add_argument("--rooms", type=int, default=150)
+    p.add_argument("--duration", type=float, default=30)
+    p.add_argument("--live-ratio", type=float, default=0.2)
+    p.add_argument("--interval", type=float, default=2)
+    p = sub.add_parser("framer", help="弹幕分帧吞吐：旧 parse_ws_slices 对比 DanmakuFramer")
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument("--batch", type=int, default=20, help="每条 WebSocket 消息包含的弹幕数")
+    p = sub.add_parser("cmdfilter", help="按 cmd 过滤解析：全部解析对比只解析订阅的命令")
+    p.add_argument("--messages", type=int, default=200000)
+    p.add_argument("--batch", type=int, default=20, help="每条 WebSocket 消息包含的命令数")
+    p.add_argument("--danmu-ratio", type=float, default=0.2, help="命令中弹幕所占比例，其余为进场、在线榜等")
+    p = sub.add_parser("detect", help="WebSocket 开播检测延迟")
+    p.add_argument("--rooms", type=int, default=50)
+    p.add_argument("--duration", type=float, default=10)
+    p.add_argument("--live-ratio", type=float, default=0.5)
+    p = sub.add_parser("danmaku", help="弹幕端到端吞吐：模拟弹幕服务器 -> danmu_listener -> 写盘队列")
+    p.add_argument("--rate", type=float, default=50000, help="每分钟推送的弹幕条数，0 为不限速")
+    p.add_argument("--duration", type=float, default=30)
+    p.add_argument("--batch", type=int, default=20, help="每条 WebSocket 消息包含的弹幕数")
+    p.add_argument("--vers", default="0,2,3", help="轮换使用的协议版本（0 原始，2 zlib，3 brotli）")
+    p.add_argument("--drop-every", type=float, default=0, help="服务端每隔多少秒断开连接，0 不断开")
+    p.add_argument("--replay", help="回放的命令文件（JSONL，每行一条命令），不填则合成 DANMU_MSG")
+    p = sub.add_parser("store", help="弹幕库：写入吞吐、片段导出、整场导出与搜索耗时")
+    p.add_argument("--rows", type=int, default=1000000)
+    p.add_argument("--rate", type=float, default=3000, help="模拟的每分钟弹幕数，决定弹幕在时间轴上的密度")
+    p.add_argument("--clip", type=float, default=600, help="片段导出的时长（秒）")
+    p = sub.add_parser("layout", help="弹幕排布：百万条密集弹幕的排布耗时、合并 / 丢弃条数")
+    p.add_argument("--comments", type=int, default=1000000)
+    p.add_argument("--rate", type=float, default=20000, help="每分钟弹幕数")
+    p.add_argument("--dup-ratio", type=float, default=0.3, help="刷屏重复短语的比例")
+    p = sub.add_parser("highlight", help="高光检测：读库、向量化打分、选峰的耗时与命中率（需要 numpy）")
+    p.add_argument("--messages", type=int, default=3000000)
+    p.add_argument("--hours", type=float, default=4)
+    p.add_argument("--bursts", type=int, default=8, help="注入的弹幕突增段数")
+    p = sub.add_parser("reconnect", help="进程内拉流：断线续录的断档时长")
+    p.add_argument("--kind", choices=("hls", "flv"), default="hls")
+    p.add_argument("--duration", type=float, default=20)
+    p.add_argument("--drop-every", type=float, default=4)
+    p = sub.add_parser("transcode", help="带弹幕压制：单个 ffmpeg 对比分段并行（需要 ffmpeg）")
+    p.add_argument("--seconds", type=int, default=120, help="合成测试视频的时长")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 4)
+    p.add_argument("--chunk-seconds", type=int, default=15)
+    p = sub.add_parser("all", help="依次运行各项压测，配合 -o 保存结果用于对比回归")
+    p.add_argument("--with-transcode", action="store_true", help="同时运行 transcode（需要 ffmpeg，耗时较长）")
+    args = parser.parse_args(argv)
+
+    if args.bench == "poll":
+        result = asyncio.run(bench_poll(args.rooms, args.duration, args.live_ratio, args.interval))
+    elif args.bench == "framer":
+        result = bench_framer(args.messages, args.batch)
+    elif args.bench == "cmdfilter":
+        result = bench_cmd_filter(args.messages, args.batch, args.danmu_ratio)
+    elif args.bench == "detect":
+        result = asyncio.run(bench_detect(args.rooms, args.duration, args.live_ratio))
+    elif args.bench == "danmaku":
+        vers = tuple(int(v) for v in args.vers.split(","))
+        result = asyncio.run(bench_danmaku(args.rate, args.duration, args.batch, vers, args.drop_every, args.replay))
+    elif args.bench == "store":
+        result = bench_store(args.rows, args.rate, args.clip)
+    elif args.bench == "layout":
+        result = bench_layout(args.comments, args.rate, args.dup_ratio)
+    elif args.bench == "highlight":
+        result = bench_highlight(args.messages, args.hours, args.bursts)
+    elif args.bench == "all":
+        result = asyncio.run(bench_all(args.with_transcode))
+    elif args.bench == "reconnect":
+        result = asyncio.run(bench_reconnect(args.kind, args.duration, args.drop_every))
+    elif args.bench == "transcode":
+        result = asyncio.run(bench_transcode(args.seconds, args.workers, args.chunk_seconds))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+if __name__ == "__main__":
+    sys.exit(main())
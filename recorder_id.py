@@ -1,24 +1,48 @@
 import os
 import re
 import time
+import sys
 import json
+import shutil
 import struct
+import asyncio
+import argparse
+import queue
 import threading
-import subprocess
 import requests
 import zlib
+import sqlite3
+import bisect
+import heapq
+import hashlib
 import brotli  # 如果服务器返回的是 Brotli 压缩
 
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+from xml.sax.saxutils import escape
 
-# 尝试导入 websocket，不可用时退回轮询
+# 尝试导入 aiohttp（异步 WebSocket），不可用时退回轮询
 try:
-    import websocket
+    import aiohttp
     WS_AVAILABLE = True
 except ImportError:
     WS_AVAILABLE = False
 
+# 尝试导入 orjson（更快的 JSON 解析），不可用时用标准库
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 尝试导入 numpy（高光检测），不可用时跳过高光检测
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # ========== 用户配置 ==========
 room_url="https://live.bilibili.com/把我替换成直播间号比如299"                # 直播间 URL 或 房间号
 save_dir=r"把我换成你要放录播的文件夹"                       # 录播文件保存目录
@@ -28,13 +52,63 @@ chat_id="可不填"                                    # Telegram Chat ID
 prefix="【把我换成主播的名字，规范命名】_"                                # 文件名前缀，包含主播名
 check_interval= 10   # 异常重试 / HTTP 轮询检测间隔（秒）
 no_stream_timeout= 600  # 超过此秒数无数据判定断播结束（秒）
+rooms_file=r""  # 多房间列表文件（每行：直播间URL或房间号 [文件名前缀]），留空则只录制 room_url
+max_concurrent_recordings= 4  # 同时进行的录制数上限，超出的房间排队等待
+poll_batch_size= 50  # HTTP 轮询时每次批量查询的房间数
+poll_min_interval= 5  # 临近主播常规开播时间时的轮询间隔（秒）
+poll_max_interval= 120  # 长时间未开播房间的最大轮询间隔（秒）
+api_rate_limit= 5  # 每个 API 主机每秒最多请求数（令牌桶）
+stream_engine="streamlink"  # 拉流方式："streamlink" 每段启动外部进程；"native" 进程内直接拉流，复用连接、断线秒级续录
+stream_qn= 10000  # 内置拉流的画质 qn（10000 为原画）
+parallel_encode_workers= 0  # 带弹幕版本分段并行压制的 ffmpeg 进程数，0 或 1 表示不分段
+parallel_chunk_seconds= 300  # 分段并行压制时每段的大致时长（秒），实际在关键帧处切开
+danmaku_queue_size= 10000  # 弹幕写入队列上限，写盘跟不上时新弹幕被丢弃并计数
+danmaku_flush_lines= 200  # 攒够多少条弹幕提交一次弹幕库
+danmaku_flush_interval= 1.0  # 最长多少秒提交一次弹幕库（秒）
+danmaku_fsync_interval= 10  # 多少秒 checkpoint 一次落盘（秒），0 表示每次提交都 checkpoint
+danmaku_layout= True  # 压制用的 ASS 按轨道排布弹幕（滚动、不重叠）；False 为旧版全部显示在左上角
+danmaku_font_size= 40  # 排布弹幕的字号（ASS 画布 1920x1080 下的像素）
+danmaku_scroll_seconds= 8  # 滚动弹幕横穿画面的大致时长（秒），决定滚动速度
+danmaku_fixed_seconds= 4  # 顶部 / 底部固定弹幕的显示时长（秒）
+danmaku_area= 0.6  # 弹幕最多占用的画面高度比例（从顶部算起）
+danmaku_max_on_screen= 150  # 同屏最多弹幕数，超出的丢弃，0 表示只受轨道数限制
+danmaku_max_delay= 1.0  # 没有空闲轨道时最多推迟多少秒显示，仍没有则丢弃（秒）
+danmaku_merge_window= 10  # 多少秒内的重复弹幕合并成一条并显示“×N”（秒），0 表示不合并
+highlight_clips= 0  # 下播后按弹幕突增自动切出几段高光片段（需要 numpy），0 表示不切
+highlight_window= 30  # 统计弹幕速率的窗口长度（秒）
+highlight_baseline= 600  # 与前后多长时间内的平均水平比较（秒），得分看的是相对平时的突增而不是绝对条数
+highlight_lead= 20  # 片段从弹幕突增前多少秒开始（弹幕通常比画面晚几秒到十几秒）（秒）
+highlight_separation= 300  # 两段高光之间的最小间隔（秒）
+highlight_min_score= 3  # 突增得分低于此值的不算高光（约等于高出平时几个标准差），弹幕平淡的场次可能一段也切不出
+api_cache_ttl={"room_init": 3600, "getDanmuInfo": 120}  # 各接口结果的缓存时间（秒），未列出的接口不缓存
+api_cache_size= 1024  # API 结果缓存条数上限，超出后淘汰最久未用的
+api_base="https://api.live.bilibili.com"  # B站直播 API 地址（压测时可指向本地模拟服务）
+danmu_ws_scheme="wss"  # 弹幕服务器协议，压测连接本地模拟服务时用 "ws"
+metrics_port= 0  # 运行指标 HTTP 端口（/metrics 为 Prometheus 文本格式，/metrics.json 为 JSON），0 表示不开启
+metrics_host="127.0.0.1"  # 运行指标 HTTP 监听地址
+metrics_dump_interval= 0  # 每隔多少秒把运行指标写入 保存目录/metrics.json，0 表示不写
+profile_hot_paths= False  # 采样分析弹幕接收、解析热点，调用栈写入 保存目录/profile_collapsed.txt
+profile_interval= 0.005  # 采样分析的采样间隔（秒）
+scratch_dir=r""  # 本地高速盘（SSD）上的工作目录：分段、合并、压制都在这里进行，处理完后台搬到 save_dir；留空表示直接写 save_dir
+move_rate_limit= 0  # 搬到保存目录的速度上限（MB/s），避免占满 NAS 带宽，0 表示不限速
+scratch_keep_gb= 0  # 已搬走的录制在工作目录中最多保留多少 GB（方便就地重新处理），超出后从最早搬走的开始删除
+scratch_min_free_gb= 20  # 工作目录所在磁盘剩余空间低于此值（GB）时，即使未超出保留上限也删除已搬走的录制
+resume_on_start= True  # 启动时把上次未处理完的录制（进程中断时遗留的合并 / 压制）重新加入后期处理队列
+postprocess_cpu_workers= 1  # 同时进行的压制任务数（每个都会占满 CPU；分段并行压制整体算一个）
+postprocess_io_workers= 2  # 同时进行的合并、转封装、切高光片段等轻量任务数
 # ==============================
 
-# 全局标志
-stop_recording_flag = False  # 收到下播通知或超时需停止录制
+@dataclass
+class Room:
+    """一个被监控的直播间"""
+    url: str             # 直播间 URL 或 房间号
+    prefix: str          # 文件名前缀，包含主播名
+    real_rid: str = ""   # 真实房间号（启动后解析）
 
-# 确保保存目录存在
-Path(save_dir).mkdir(parents=True, exist_ok=True)
+    @property
+    def room_id(self) -> str:
+        """从 URL 中提取房间号（可能是短号）"""
+        return self.url.rstrip("/").split("/")[-1]
 
 def now_str(fmt: str = "%Y%m%d_%H%M%S") -> str:
     """获取当前时间的字符串，默认格式为年月日_时分秒，用于文件名"""
@@ -50,17 +124,303 @@ def send_tg_message(text: str):
     except Exception as e:
         print(f"❌ Telegram 发送失败: {e}")
 
-def get_sessdata_from_cookie() -> str:
-    """从 Cookie 文件中提取 SESSDATA 值"""
+async def notify(text: str):
+    """在事件循环中发送 Telegram 通知，不阻塞其他房间"""
+    await asyncio.to_thread(send_tg_message, text)
+
+def write_text_atomic(path: Path, text: str):
+    """先写临时文件再替换，读取方不会看到写了一半的内容"""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+# ========== 运行指标 ==========
+class Metrics:
+    """
+    运行指标：计数器、汇总（次数 / 总和 / 最大值）和按需取值的仪表，以 名称+标签 区分，线程安全。
+    可导出为 Prometheus 文本格式或 JSON。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}   # (名称, 标签) -> 累计值
+        self.summaries = {}  # (名称, 标签) -> [次数, 总和, 最大值]
+        self.gauges = {}     # (名称, 标签) -> 取值函数
+
+    @staticmethod
+    def key(name: str, labels: dict):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        """计数器加 amount"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """记录一次观测值（分段大小、耗时等）"""
+        key = self.key(name, labels)
+        with self.lock:
+            s = self.summaries.setdefault(key, [0, 0.0, value])
+            s[0] += 1
+            s[1] += value
+            s[2] = max(s[2], value)
+
+    def gauge(self, name: str, fn, **labels):
+        """登记一个仪表，导出时调用 fn() 取当前值"""
+        with self.lock:
+            self.gauges[self.key(name, labels)] = fn
+
+    def remove_gauge(self, name: str, **labels):
+        with self.lock:
+            self.gauges.pop(self.key(name, labels), None)
+
+    def collect(self) -> list:
+        """返回 [(类型, 名称, 标签, 值)]，汇总的值为 (次数, 总和, 最大值)"""
+        with self.lock:
+            counters = list(self.counters.items())
+            summaries = [(k, tuple(v)) for k, v in self.summaries.items()]
+            gauges = list(self.gauges.items())
+        rows = [("counter", name, labels, v) for (name, labels), v in counters]
+        rows += [("summary", name, labels, v) for (name, labels), v in summaries]
+        for (name, labels), fn in gauges:
+            try:
+                rows.append(("gauge", name, labels, fn()))
+            except Exception:
+                pass  # 取值失败（对象已释放等）时跳过
+        return sorted(rows, key=lambda r: (r[1], r[2]))
+
+    def snapshot(self) -> dict:
+        """JSON 格式：{名称: [{"labels": {...}, "value": 值} 或 {"labels", "count", "sum", "max"}]}"""
+        out = {}
+        for kind, name, labels, value in self.collect():
+            row = {"labels": dict(labels)}
+            if kind == "summary":
+                row.update(count=value[0], sum=round(value[1], 6), max=round(value[2], 6))
+            else:
+                row["value"] = value
+            out.setdefault(name, []).append(row)
+        return {"time": datetime.now().isoformat(timespec="seconds"), "metrics": out}
+
+    def render_prometheus(self) -> str:
+        """Prometheus 文本格式；汇总导出为 _count、_sum 和 _max 三项"""
+        lines = []
+        typed = set()
+        for kind, name, labels, value in self.collect():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            tags = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+            tags = f"{{{tags}}}" if tags else ""
+            if kind == "summary":
+                lines += [f"{name}_count{tags} {value[0]}", f"{name}_sum{tags} {value[1]}", f"{name}_max{tags} {value[2]}"]
+            else:
+                lines.append(f"{name}{tags} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def handle_metrics_request(reader, writer):
+    """极简 HTTP 处理：GET /metrics 返回 Prometheus 文本，GET /metrics.json 返回 JSON"""
     try:
-        content = Path(cookie_file).read_text(encoding="utf-8")
-        # 在Cookie文本中查找 SESSDATA=<值>
-        m = re.search(r"SESSDATA=([^;\s]+)", content)
-        if m:
-            return m.group(1)
-    except Exception as e:
-        print(f"⚠️ 无法读取 Cookie 文件或提取 SESSDATA: {e}")
-    return ""
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass  # 丢弃请求头
+        fields = request_line.split()
+        path = fields[1].split(b"?")[0] if len(fields) > 1 else b""
+        if path == b"/metrics":
+            status, ctype, body = "200 OK", "text/plain; version=0.0.4", metrics.render_prometheus()
+        elif path == b"/metrics.json":
+            status, ctype, body = "200 OK", "application/json", json.dumps(metrics.snapshot(), ensure_ascii=False)
+        else:
+            status, ctype, body = "404 Not Found", "text/plain", "not found\n"
+        data = body.encode("utf-8")
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+    except Exception:
+        pass  # 客户端断开或请求格式不对，直接关闭连接
+    finally:
+        writer.close()
+
+class HotPathProfiler:
+    """
+    采样分析：后台线程每隔 profile_interval 抓取一次事件循环线程的调用栈，
+    只统计经过弹幕接收、分帧解析的样本，按折叠栈格式汇总（flamegraph.pl、speedscope 可直接读取）。
+    """
+
+    HOT_PATHS = {"receive_loop", "on_danmaku", "feed"}  # 本文件中的热点函数
+
+    def __init__(self, path: Path, thread_id: int):
+        self.path = path
+        self.thread_id = thread_id  # 被采样的线程（事件循环所在线程）
+        self.stacks = Counter()     # 折叠栈 -> 样本数
+        self.samples = 0            # 总样本数
+        self.hot = 0                # 落在热点路径上的样本数
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="hot-path-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        print(f"🔬 热点采样分析已开启，每 {profile_interval}s 采样一次，结果写入 {self.path}")
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(5)
+
+    def sample(self):
+        """抓取一次调用栈，经过热点函数时计入"""
+        frame = sys._current_frames().get(self.thread_id)
+        self.samples += 1
+        names = []
+        hot = False
+        while frame is not None:
+            code = frame.f_code
+            hot = hot or (code.co_name in self.HOT_PATHS and code.co_filename == __file__)
+            names.append(f"{code.co_name} ({Path(code.co_filename).name})")
+            frame = frame.f_back
+        if hot:
+            self.hot += 1
+            self.stacks[";".join(reversed(names))] += 1
+
+    def dump(self):
+        try:
+            write_text_atomic(self.path, "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common()))
+        except Exception as e:
+            print(f"⚠️ 写入采样结果失败: {e}")
+
+    def run(self):
+        last_dump = time.monotonic()
+        while not self.stop_event.wait(profile_interval):
+            self.sample()
+            if time.monotonic() - last_dump >= 10:
+                self.dump()
+                last_dump = time.monotonic()
+        self.dump()
+        if self.samples:
+            print(f"🔬 采样 {self.samples} 次，热点路径占 {self.hot / self.samples:.1%}")
+
+async def dump_metrics(path: Path):
+    """在线程中写 metrics.json：保存目录可能是慢速网络盘，写入卡住时不能拖住事件循环"""
+    text = json.dumps(metrics.snapshot(), ensure_ascii=False, indent=1)
+    try:
+        await asyncio.to_thread(write_text_atomic, path, text)
+    except OSError as e:
+        print(f"⚠️ 写入运行指标失败: {e}")
+
+async def serve_metrics():
+    """后台任务：按配置开启指标 HTTP 端口、定时写 metrics.json、热点采样分析；取消时一并停止"""
+    if not (metrics_port or metrics_dump_interval or profile_hot_paths):
+        return
+    server = profiler = None
+    dump_path = Path(save_dir) / "metrics.json"
+    try:
+        if metrics_port:
+            server = await asyncio.start_server(handle_metrics_request, metrics_host, metrics_port)
+            print(f"📊 运行指标：http://{metrics_host}:{metrics_port}/metrics")
+        if profile_hot_paths:
+            profiler = HotPathProfiler(Path(save_dir) / "profile_collapsed.txt", threading.get_ident())
+            profiler.start()
+        while True:
+            await asyncio.sleep(metrics_dump_interval or 3600)
+            if metrics_dump_interval:
+                await dump_metrics(dump_path)
+    finally:
+        if server is not None:
+            server.close()
+        if profiler is not None:
+            await asyncio.to_thread(profiler.stop)
+        if metrics_dump_interval:
+            await dump_metrics(dump_path)
+
+# ========== B站 API 客户端 ==========
+class BiliApiClient:
+    """
+    所有 B站 API 请求共用的客户端：
+    - 一个 requests.Session，复用 keep-alive 连接；
+    - SESSDATA 缓存在内存，Cookie 文件 mtime 变化时才重新读取；
+    - room_init / getDanmuInfo 等结果按接口 TTL 缓存，超出条数上限按 LRU 淘汰；
+    - 统计缓存命中、未命中次数。
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = "Mozilla/5.0"
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # (接口, 参数) -> (过期时间, 响应)
+        self.cookie_mtime = None
+        self.sessdata = ""
+        self.hits = 0
+        self.misses = 0
+        self.cookie_reloads = 0
+
+    def get_sessdata(self) -> str:
+        """返回 SESSDATA；Cookie 文件未修改时直接用内存中的值"""
+        try:
+            mtime = os.stat(cookie_file).st_mtime_ns
+        except OSError as e:
+            if self.cookie_mtime is not False:
+                print(f"⚠️ 无法读取 Cookie 文件或提取 SESSDATA: {e}")
+            self.cookie_mtime, self.sessdata = False, ""  # 记住失败状态，避免重复提示
+            return ""
+        if mtime != self.cookie_mtime:
+            self.cookie_mtime = mtime
+            self.cookie_reloads += 1
+            try:
+                content = Path(cookie_file).read_text(encoding="utf-8")
+                # 在Cookie文本中查找 SESSDATA=<值>
+                m = re.search(r"SESSDATA=([^;\s]+)", content)
+                self.sessdata = m.group(1) if m else ""
+            except Exception as e:
+                print(f"⚠️ 无法读取 Cookie 文件或提取 SESSDATA: {e}")
+                self.sessdata = ""
+        return self.sessdata
+
+    def get_json(self, path: str, params=None, cache: str = None) -> dict:
+        """
+        请求 api_base + path 并解析 JSON。cache 为接口名时按 api_cache_ttl 缓存成功（code=0）的结果；
+        网络异常直接抛出，由调用方处理。
+        """
+        ttl = api_cache_ttl.get(cache) if cache else None
+        key = (cache, path, repr(params))
+        if ttl:
+            with self.lock:
+                entry = self.cache.get(key)
+                if entry and entry[0] > time.monotonic():
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+        resp = self.session.get(f"{api_base}{path}", params=params, headers=get_cookie_header(), timeout=5).json()
+        if ttl and resp.get("code") == 0:
+            with self.lock:
+                self.cache[key] = (time.monotonic() + ttl, resp)
+                self.cache.move_to_end(key)
+                while len(self.cache) > api_cache_size:
+                    self.cache.popitem(last=False)
+        return resp
+
+    def invalidate(self, cache: str, params=None):
+        """丢弃某个接口的缓存（如弹幕 token 失效时）；给出 params 时只丢弃这组参数的那一条，其他房间的缓存保留"""
+        with self.lock:
+            for key in [k for k in self.cache if k[0] == cache and (params is None or k[2] == repr(params))]:
+                del self.cache[key]
+
+    def stats(self) -> dict:
+        """缓存命中统计"""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.cache),
+                "cookie_reloads": self.cookie_reloads}
+
+api_client = BiliApiClient()
+metrics.gauge("recorder_api_cache_hits", lambda: api_client.hits)
+metrics.gauge("recorder_api_cache_misses", lambda: api_client.misses)
+
+def get_sessdata_from_cookie() -> str:
+    """从 Cookie 文件中提取 SESSDATA 值（文件未修改时使用缓存）"""
+    return api_client.get_sessdata()
 
 def get_cookie_header() -> dict:
     """构造包含 SESSDATA 的请求头字典"""
@@ -71,13 +431,8 @@ def get_cookie_header() -> dict:
 
 def get_live_title(real_rid: str) -> str:
     """获取当前直播间标题，并替换文件名不允许的字符"""
-    headers = {"User-Agent": "Mozilla/5.0"}
-    headers.update(get_cookie_header())
     try:
-        resp = requests.get(
-            f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={real_rid}",
-            headers=headers, timeout=5
-        ).json()
+        resp = api_client.get_json("/room/v1/Room/get_info", {"room_id": real_rid})
         if resp.get("code") == 0:
             raw_title = resp["data"].get("title", "").strip()
             # 替换文件名中的非法字符：\/:*?"<>|
@@ -88,13 +443,8 @@ def get_live_title(real_rid: str) -> str:
 
 def get_real_room_id(rid: str) -> str:
     """将可能的短房间号转换为直播的真实房间号"""
-    headers = {"User-Agent": "Mozilla/5.0"}
-    headers.update(get_cookie_header())
     try:
-        resp = requests.get(
-            f"https://api.live.bilibili.com/room/v1/Room/room_init?id={rid}",
-            headers=headers, timeout=5
-        ).json()
+        resp = api_client.get_json("/room/v1/Room/room_init", {"id": rid}, cache="room_init")
         if resp.get("code") == 0:
             return str(resp["data"]["room_id"])
     except Exception as e:
@@ -104,387 +454,2397 @@ def get_real_room_id(rid: str) -> str:
 
 def get_danmu_server_info(rid: str):
     """获取 B站弹幕服务器的 WebSocket 接入点和鉴权token"""
-    headers = {"User-Agent": "Mozilla/5.0"}
-    headers.update(get_cookie_header())
     try:
-        resp = requests.get(
-            f"https://api.live.bilibili.com/xlive/web-room/v1/index/getDanmuInfo?id={rid}",
-            headers=headers, timeout=5
-        ).json()
+        resp = api_client.get_json("/xlive/web-room/v1/index/getDanmuInfo", {"id": rid}, cache="getDanmuInfo")
         if resp.get("code") == 0:
             data = resp["data"]
             host = data["host_list"][0]["host"]
             token = data["token"]
-            port = data["host_list"][0].get("wss_port", 443)
+            port = data["host_list"][0].get("ws_port" if danmu_ws_scheme == "ws" else "wss_port", 443)
             # 返回 WebSocket 接入URL 和认证需要的 token
-            return f"wss://{host}:{port}/sub", token
+            return f"{danmu_ws_scheme}://{host}:{port}/sub", token
     except Exception as e:
         print(f"⚠️ 获取弹幕服务器信息失败: {e}")
     return None, None
 
-def wait_for_live(real_rid: str) -> bool:
-    """
-    等待直播开播：优先使用 WebSocket 弹幕连接等待“LIVE”信号，失败则使用 HTTP 轮询。
-    当检测到开播时返回 True。
-    """
-    # 定义HTTP轮询检查直播开播状态的函数
-    def http_check():
-        headers = {"User-Agent": "Mozilla/5.0"}
-        headers.update(get_cookie_header())
-        try:
-            resp = requests.get(
-                f"https://api.live.bilibili.com/room/v1/Room/get_info?room_id={real_rid}",
-                headers=headers, timeout=5
-            ).json()
+# ========== 批量开播状态轮询 ==========
+class TokenBucket:
+    """令牌桶限速：每秒补充 rate 个令牌，最多累积 burst 个"""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        """预扣令牌，返回拿到令牌前需要等待的秒数（不足时记为欠账，由调用方等待）"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, amount: float = 1):
+        """异步等待直到拿到令牌"""
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+_host_buckets = {}  # 主机名 -> 令牌桶
+
+def host_bucket(url: str) -> TokenBucket:
+    """按主机名获取令牌桶，同一主机的所有请求共享限速"""
+    host = urlsplit(url).netloc
+    if host not in _host_buckets:
+        _host_buckets[host] = TokenBucket(api_rate_limit)
+    return _host_buckets[host]
+
+def get_live_status_batch(rids: list) -> dict:
+    """批量查询直播状态，返回 {真实房间号: live_status}；请求失败时返回空字典"""
+    params = [("req_biz", "web_room_componet")] + [("room_ids", rid) for rid in rids]
+    try:
+        resp = api_client.get_json("/xlive/web-room/v1/index/getRoomBaseInfo", params)
+        if resp.get("code") == 0:
+            rooms = resp["data"].get("by_room_ids") or {}
             # live_status 返回 1 表示正在直播，2 表示轮播，0 表示未开播
-            return resp.get("data", {}).get("live_status", 0) != 0
+            return {str(rid): int(info.get("live_status", 0)) for rid, info in rooms.items()}
+    except Exception as e:
+        print(f"⚠️ 批量查询直播状态失败: {e}")
+    return {}
+
+class LiveHistory:
+    """记录各房间的历史开播时间，用来推测主播的常规开播时段"""
+
+    def __init__(self, path: Path, keep: int = 30):
+        self.path = path
+        self.keep = keep  # 每个房间保留最近多少次开播记录
+        self.lock = threading.Lock()
+        self.version = 0  # 每次记录加一
+        self.saved = 0    # 已写入文件的版本，后台写入先后颠倒时不用旧内容覆盖新内容
+        try:
+            self.starts = json.loads(path.read_text(encoding="utf-8"))
         except Exception:
-            return False
+            self.starts = {}
+
+    async def add(self, rid: str, ts: float):
+        """记录一次开播，在线程中写回文件（保存目录可能是慢速网络盘，不能卡住事件循环）"""
+        starts = self.starts.setdefault(rid, [])
+        starts.append(ts)
+        del starts[:-self.keep]
+        self.version += 1
+        await asyncio.to_thread(self.save, json.dumps(self.starts), self.version)
 
-    # 优先尝试 WebSocket 接口监听直播状态
-    if WS_AVAILABLE:
-        wss_url, token = get_danmu_server_info(real_rid)
-        if wss_url and token:
-            print(f"📺 使用 WebSocket 监听开播：{room_url}")
+    def save(self, text: str, version: int):
+        with self.lock:
+            if version <= self.saved:
+                return
             try:
-                ws = websocket.create_connection(wss_url, timeout=10)
-                # 发送认证包
-                auth_params = {
-                    "uid": 0,
-                    "roomid": int(real_rid),
-                    "protover": 2,
-                    "platform": "web",
-                    "type": 2,
-                    "key": token
-                }
-                body = json.dumps(auth_params).encode()
-                # 构造弹幕协议头部：长度、头部长度、协议版本、操作码、序列
-                header = struct.pack(">IHHII", 16 + len(body), 16, 1, 7, 1)
-                ws.send(header + body)
-                # 开启心跳线程，每30秒发送心跳包保持连接
-                def send_heartbeats():
-                    packet = struct.pack(">IHHII", 16, 16, 1, 2, 1)
-                    while True:
-                        try:
-                            ws.send(packet)
-                        except Exception:
-                            break
-                        time.sleep(30)
-                threading.Thread(target=send_heartbeats, daemon=True).start()
-
-                # 等待服务端消息
-                while True:
-                    msg = ws.recv()
-                    if not msg:
-                        break  # 连接关闭
-                    if isinstance(msg, bytes) and len(msg) >= 16:
-                        # 从消息字节中提取操作码
-                        op = struct.unpack(">I", msg[8:12])[0]
-                        if op == 5:  # 普通数据包 (命令包)
-                            ver = struct.unpack(">H", msg[6:8])[0]
-                            data = msg[16:]
-                            # 压缩的弹幕数据需解压
-                            if ver == 2:
-                                try:
-                                    data = zlib.decompress(data)
-                                except Exception:
-                                    pass
-                            # 解析可能包含多条信息的数据
-                            for sub_json in parse_ws_slices(data):
-                                cmd = sub_json.get("cmd", "")
-                                if cmd == "LIVE":
-                                    print("📢 WebSocket 检测到开播！")
-                                    ws.close()
-                                    return True  # 收到开播消息
-                                elif cmd == "DANMU_MSG":
-                                    # 处理实时收到的弹幕消息（此处仅打印，录制线程会另外处理）
-                                    danmu_text = sub_json["info"][1][1]
-                                    user = sub_json["info"][2][1]
-                                    print(f"[弹幕] {user}: {danmu_text}")
-                                # 可以扩展处理其他消息类型：如 SEND_GIFT、INTERACT_WORD 等
-                        elif op == 8:
-                            # 操作码8：进入房间/认证成功的确认包
-                            # 不做处理，继续等待“LIVE”指令
-                            pass
-                ws.close()
+                write_text_atomic(self.path, text)
+                self.saved = version
             except Exception as e:
-                print(f"❌ WebSocket 监听异常：{e}")
+                print(f"⚠️ 保存开播记录失败: {e}")
 
-    # 如果 WebSocket 检测不可用或发生异常，使用 HTTP 接口轮询直播状态
-    print(f"📡 HTTP 轮询等待开播：{room_url}")
-    while True:
-        if http_check():
-            print("📢 HTTP 检测到开播！")
-            return True
-        time.sleep(check_interval)
+    def near_usual_start(self, rid: str, now: float, window: int = 1800) -> bool:
+        """当前时刻是否落在该房间以往开播时刻（按一天中的时间算）前后 window 秒内"""
+        t = time.localtime(now)
+        sec = t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec
+        for ts in self.starts.get(rid, ()):
+            s = time.localtime(ts)
+            d = abs(sec - (s.tm_hour * 3600 + s.tm_min * 60 + s.tm_sec))
+            if min(d, 86400 - d) <= window:
+                return True
+        return False
 
-def parse_ws_slices(blob: bytes) -> list:
-    """解析 WebSocket 数据包，提取可能包含的多条JSON消息"""
-    results = []
-    offset = 0
-    # 按照弹幕协议逐段解析
-    while offset + 16 <= len(blob):
-        # 数据包长度、头部长度、版本、操作码
-        packet_len = int.from_bytes(blob[offset:offset+4], "big")
-        header_len = int.from_bytes(blob[offset+4:offset+6], "big")
-        ver = int.from_bytes(blob[offset+6:offset+8], "big")
-        op = int.from_bytes(blob[offset+8:offset+12], "big")
-        body = blob[offset + header_len: offset + packet_len]
-        if op == 5:  # 弹幕数据
-            if ver in (2, 3):
-                try:
-                    if ver == 2:
-                        body = zlib.decompress(body)
-                    else:
-                        body = brotli.decompress(body)
-                except Exception:
-                    pass
-                # 递归解析解压后的数据
-                results.extend(parse_ws_slices(body))
+class LiveStatusPoller:
+    """批量、自适应的开播状态轮询：所有走 HTTP 轮询的房间共用一个轮询任务"""
+
+    def __init__(self, history: LiveHistory):
+        self.history = history
+        self.waiters = {}     # 房间号 -> 开播时完成的 Future
+        self.next_due = {}    # 房间号 -> 下次查询时间（monotonic）
+        self.idle_since = {}  # 房间号 -> 开始等待开播的时间
+        self.requests_sent = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def interval_for(self, rid: str, now: float) -> float:
+        """轮询间隔：临近常规开播时段加密，长时间未开播则逐步退避"""
+        if self.history.near_usual_start(rid, now):
+            return poll_min_interval
+        idle_hours = (now - self.idle_since[rid]) / 3600
+        return min(poll_max_interval, check_interval * (1 + idle_hours))
+
+    async def wait_live(self, rid: str) -> bool:
+        """登记房间并等待其开播"""
+        fut = self.waiters.get(rid)
+        if fut is None or fut.done():
+            fut = asyncio.get_running_loop().create_future()
+            self.waiters[rid] = fut
+            self.next_due[rid] = time.monotonic()
+            self.idle_since[rid] = time.time()
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        try:
+            return await asyncio.shield(fut)
+        finally:
+            if not fut.done():  # 调用方被取消，不再轮询该房间
+                self.forget(rid)
+
+    async def check(self, rid: str):
+        """立即查询一次房间是否在播（与轮询共用限速），返回 True / False，查询失败时返回 None"""
+        await host_bucket(api_base).acquire()
+        self.requests_sent += 1
+        status = (await asyncio.to_thread(get_live_status_batch, [rid])).get(rid)
+        return None if status is None else status != 0
+
+    def forget(self, rid: str):
+        """移除房间的轮询登记"""
+        self.waiters.pop(rid, None)
+        self.next_due.pop(rid, None)
+        self.idle_since.pop(rid, None)
+
+    def pick_due(self, now: float) -> list:
+        """选出已到期的房间；最后一批有空位时，顺带查询即将到期的房间以减少请求数"""
+        due = [rid for rid, t in self.next_due.items() if t <= now]
+        spare = -len(due) % poll_batch_size
+        if due and spare:
+            upcoming = sorted((t, rid) for rid, t in self.next_due.items() if now < t <= now + poll_min_interval)
+            due.extend(rid for _, rid in upcoming[:spare])
+        return due
+
+    def dispatch(self, batch: list, statuses: dict):
+        """根据批量查询结果唤醒开播的房间，并安排其余房间的下次查询"""
+        now = time.time()
+        for rid in batch:
+            fut = self.waiters.get(rid)
+            if fut is None:
+                continue  # 查询期间已取消登记
+            status = statuses.get(rid)
+            if status is None:
+                self.next_due[rid] = time.monotonic() + check_interval  # 查询失败，按默认间隔重试
+            elif status != 0:
+                self.forget(rid)
+                fut.set_result(True)
             else:
+                self.next_due[rid] = time.monotonic() + self.interval_for(rid, now)
+
+    async def run(self):
+        """轮询主循环：按到期时间分批查询，同一主机的请求经过令牌桶限速"""
+        while self.waiters:
+            now = time.monotonic()
+            due = self.pick_due(now)
+            if not due:
+                # 睡到最早的到期时间，或有新房间登记时提前醒来
+                self.wakeup.clear()
                 try:
-                    results.append(json.loads(body.decode("utf-8", errors="ignore")))
-                except Exception:
+                    await asyncio.wait_for(self.wakeup.wait(), min(self.next_due.values()) - now)
+                except asyncio.TimeoutError:
                     pass
-        # 移动偏移量到下一个包起始
-        offset += packet_len
-    return results
+                continue
+            for i in range(0, len(due), poll_batch_size):
+                batch = due[i:i + poll_batch_size]
+                await host_bucket(api_base).acquire()
+                self.requests_sent += 1
+                statuses = await asyncio.to_thread(get_live_status_batch, batch)
+                self.dispatch(batch, statuses)
 
-def danmu_listener(real_rid: str, danmaku_path: Path, start_time: datetime, stop_event: threading.Event):
-    """独立线程：连接弹幕服务器抓取弹幕，自动重连并写入ASS弹幕文件"""
-    # 如果弹幕ASS文件不存在，先写入ASS文件头
-    if not danmaku_path.exists():
-        danmaku_path.write_text(
-            "[Script Info]\n"
-            "ScriptType: v4.00+\n\n"
-            "[V4+ Styles]\n"
-            "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
-            "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
-            "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
-            "Alignment, MarginL, MarginR, MarginV, Encoding\n"
-            "Style: default,Arial,36,&H00FFFFFF,&H0000FFFF,&H00000000,&H00000000,"
-            "0,0,0,0,100,100,0,0,1,2,0,7,10,10,10,1\n\n"
-            "[Events]\n"
-            "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n",
-            encoding="utf-8"
-        )
-    while not stop_event.is_set():
-        wss_url, token = get_danmu_server_info(real_rid)
-        if not wss_url:
-            time.sleep(check_interval)
-            continue
+_live_poller = None
+
+def get_live_poller() -> LiveStatusPoller:
+    """获取（必要时创建）全局共享的开播状态轮询器"""
+    global _live_poller
+    if _live_poller is None:
+        _live_poller = LiveStatusPoller(LiveHistory(Path(save_dir) / "live_history.json"))
+        metrics.gauge("recorder_poll_requests", lambda: _live_poller.requests_sent)
+    return _live_poller
+
+# ========== 弹幕 WebSocket 连接 ==========
+# 所有房间共用一个 aiohttp 会话，连接都挂在同一个事件循环上
+_http_session = None
+
+def get_http_session():
+    """获取（必要时创建）全局共享的 aiohttp 会话"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(headers={"User-Agent": "Mozilla/5.0"})
+    return _http_session
+
+async def close_http_session():
+    """关闭全局 aiohttp 会话"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+def make_packet(op: int, body: bytes = b"") -> bytes:
+    """构造弹幕协议数据包：长度、头部长度、协议版本、操作码、序列 + 包体"""
+    return struct.pack(">IHHII", 16 + len(body), 16, 1, op, 1) + body
+
+HEARTBEAT_PACKET = make_packet(2)  # 心跳包
+_heartbeat_sent = {}  # 弹幕连接 -> 最近一次发送心跳的时间（monotonic），用于统计心跳往返时间
+
+WS_RECEIVE_TIMEOUT = 70  # 弹幕连接最长多少秒收不到数据就断开重连（秒）
+
+async def send_heartbeats(ws):
+    """每30秒发送心跳包保持连接；发送失败时关闭连接，让接收循环退出并重连"""
+    while not ws.closed:
         try:
-            ws = websocket.create_connection(wss_url, timeout=10)
-            # 发送认证包加入房间
-            auth = {"uid": 0, "roomid": int(real_rid), "protover": 2, "platform": "web", "type": 2, "key": token}
-            body = json.dumps(auth).encode()
-            header = struct.pack(">IHHII", 16 + len(body), 16, 1, 7, 1)
-            ws.send(header + body)
-
-            # 开启心跳线程保持弹幕连接
-            def send_heartbeats():
-                packet = struct.pack(">IHHII", 16, 16, 1, 2, 1)
-                while True:
+            _heartbeat_sent[ws] = time.monotonic()
+            await ws.send_bytes(HEARTBEAT_PACKET)
+        except Exception:
+            await ws.close()
+            break
+        await asyncio.sleep(30)
+
+def observe_heartbeat(ws, framer, real_rid: str):
+    """分帧器解析到心跳回复时，记录一次心跳往返时间"""
+    sent = _heartbeat_sent.pop(ws, None)
+    if sent is not None:
+        metrics.observe("recorder_ws_heartbeat_rtt_seconds", framer.heartbeat_reply_at - sent, room=real_rid)
+    framer.heartbeat_reply_at = None
+
+async def open_danmu_ws(real_rid: str):
+    """连接弹幕服务器并完成认证，返回 (ws, 心跳任务)；获取接入点失败时返回 (None, None)"""
+    wss_url, token = await asyncio.to_thread(get_danmu_server_info, real_rid)
+    if not wss_url or not token:
+        return None, None
+    # 服务端每个心跳（30 秒）都会回复，超过 WS_RECEIVE_TIMEOUT 秒收不到任何数据即视为连接已死（半开的 TCP 连接）
+    if hasattr(aiohttp, "ClientWSTimeout"):
+        timeouts = {"timeout": aiohttp.ClientWSTimeout(ws_receive=WS_RECEIVE_TIMEOUT, ws_close=10)}
+    else:
+        timeouts = {"timeout": 10, "receive_timeout": WS_RECEIVE_TIMEOUT}  # aiohttp < 3.10
+    ws = await get_http_session().ws_connect(wss_url, autoping=True, **timeouts)
+    metrics.inc("recorder_ws_connects_total", room=real_rid)
+    # 发送认证包加入房间
+    auth = {"uid": 0, "roomid": int(real_rid), "protover": 2, "platform": "web", "type": 2, "key": token}
+    await ws.send_bytes(make_packet(7, json.dumps(auth).encode()))
+    # 开启心跳任务保持弹幕连接
+    heartbeat = asyncio.create_task(send_heartbeats(ws))
+    return ws, heartbeat
+
+async def close_danmu_ws(ws, heartbeat):
+    """停止心跳并关闭弹幕连接"""
+    if heartbeat is not None:
+        heartbeat.cancel()
+    _heartbeat_sent.pop(ws, None)
+    if ws is not None and not ws.closed:
+        await ws.close()
+
+class RoomEventConnection:
+    """
+    每个房间一条常驻弹幕连接，由调度器在监控房间期间一直持有：
+    自带心跳、断线自动重连，解析出的命令（LIVE、PREPARING、DANMU_MSG、SEND_GIFT、SUPER_CHAT_MESSAGE 等）
+    按 cmd 分发给订阅者，开播检测、弹幕录制、下播检测共用这一条连接。
+    """
+
+    def __init__(self, real_rid: str):
+        self.real_rid = real_rid
+        self.subscribers = {}      # cmd -> [回调]
+        self.wanted = set()        # 有订阅者的 cmd，分帧时只完整解析这些命令
+        self.framer = DanmakuFramer()  # 整个连接期间共用，解析 / 跳过计数跨重连累计
+        self.up = asyncio.Event()  # 连接已建立
+        self.down = asyncio.Event()  # 连接已断开
+        self.down.set()
+        self.connects = 0
+        self.task = None
+
+    def subscribe(self, cmds, handler):
+        """
+        订阅若干命令：同一条 WebSocket 消息中的同名命令以列表形式一次交给 handler(msgs)。
+        cmd 按去掉后缀的名字匹配（DANMU_MSG:4:0:2:2:2:0 算作 DANMU_MSG），没有订阅者的命令不做 JSON 解析。
+        handler 在接收循环中同步调用，不能阻塞；返回取消订阅的函数。
+        """
+        for cmd in cmds:
+            self.subscribers.setdefault(cmd, []).append(handler)
+        self.update_wanted()
+
+        def unsubscribe():
+            for cmd in cmds:
+                handlers = self.subscribers.get(cmd, [])
+                if handler in handlers:
+                    handlers.remove(handler)
+            self.update_wanted()
+        return unsubscribe
+
+    def update_wanted(self):
+        self.wanted = {cmd for cmd, handlers in self.subscribers.items() if handlers}
+
+    def start(self):
+        """启动连接任务（已在运行时不重复启动）"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+            metrics.gauge("recorder_ws_commands_parsed", lambda: self.framer.parsed, room=self.real_rid)
+            metrics.gauge("recorder_ws_commands_skipped", lambda: self.framer.skipped, room=self.real_rid)
+        return self
+
+    async def close(self):
+        """停止连接任务并断开连接"""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            metrics.remove_gauge("recorder_ws_commands_parsed", room=self.real_rid)
+            metrics.remove_gauge("recorder_ws_commands_skipped", room=self.real_rid)
+            parsed, skipped = self.framer.parsed, self.framer.skipped
+            if parsed + skipped:
+                print(f"📊 [{self.real_rid}] 弹幕命令解析 {parsed} 条，按 cmd 跳过 {skipped} 条"
+                      f"（{skipped / (parsed + skipped):.0%}）")
+
+    def set_up(self, up: bool):
+        (self.up if up else self.down).set()
+        (self.down if up else self.up).clear()
+
+    async def run(self):
+        """连接主循环：服务端断开时立即重连，出错时等 5 秒，获取接入点失败时按 check_interval 重试"""
+        while True:
+            ws = heartbeat = None
+            delay = 0
+            try:
+                ws, heartbeat = await open_danmu_ws(self.real_rid)
+                if ws is None:
+                    delay = check_interval
+                else:
+                    if self.connects:
+                        metrics.inc("recorder_ws_reconnects_total", room=self.real_rid)
+                    self.connects += 1
+                    self.set_up(True)
+                    connected_at = time.monotonic()
+                    await self.receive_loop(ws)
+                    if time.monotonic() - connected_at < 1:
+                        delay = 1  # 刚连上就被断开，稍等再连，避免频繁重连
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ [{self.real_rid}] 弹幕连接异常，将在5秒后重连: {e or type(e).__name__}")
+                api_client.invalidate("getDanmuInfo", {"id": self.real_rid})  # 下次重新获取本房间的接入点和 token
+                delay = 5
+            finally:
+                self.set_up(False)
+                await close_danmu_ws(ws, heartbeat)
+            if delay:
+                await asyncio.sleep(delay)
+
+    async def receive_loop(self, ws):
+        """接收并分帧解析消息，按 cmd 分发给订阅者，直到连接关闭"""
+        framer = self.framer
+        framer.reset()
+        subscribers = self.subscribers
+        while True:
+            msg = await ws.receive()
+            if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                            aiohttp.WSMsgType.ERROR):
+                return
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                continue
+            # 弹幕服务器可能将多条命令打包在一起发送，按 cmd 归组后一次分发
+            events = {}
+            for sub_json in framer.feed(msg.data, self.wanted):
+                cmd = sub_json.get("cmd", "").partition(":")[0]
+                if subscribers.get(cmd):
+                    events.setdefault(cmd, []).append(sub_json)
+            for cmd, msgs in events.items():
+                for handler in list(subscribers.get(cmd, ())):
                     try:
-                        ws.send(packet)
-                    except Exception:
-                        break
-                    time.sleep(30)
-            threading.Thread(target=send_heartbeats, daemon=True).start()
+                        handler(msgs)
+                    except Exception as e:
+                        print(f"⚠️ [{self.real_rid}] 处理 {cmd} 出错: {e}")
+            if framer.heartbeat_reply_at is not None:
+                observe_heartbeat(ws, framer, self.real_rid)
+
+async def wait_first(*aws):
+    """等待其中任意一个完成；传入的协程临时包装成任务，返回前取消"""
+    created = [asyncio.ensure_future(a) for a in aws if asyncio.iscoroutine(a)]
+    futures = [a for a in aws if not asyncio.iscoroutine(a)] + created
+    try:
+        await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in created:
+            task.cancel()
+
+async def wait_for_live(room: Room, conn: RoomEventConnection = None) -> bool:
+    """
+    等待直播开播：有常驻弹幕连接时等待其中的“LIVE”信号，连接断开期间用 HTTP 轮询兜底；
+    LIVE 只在开播那一刻推送，所以开始等待时和每次重连后先用 HTTP 查一次当前状态。
+    没有连接（aiohttp 不可用）时只用 HTTP 轮询。当检测到开播时返回 True。
+    """
+    real_rid = room.real_rid
+    # 所有轮询中的房间由同一个调度器批量查询
+    if conn is None:
+        print(f"📡 HTTP 轮询等待开播：{room.url}")
+        await get_live_poller().wait_live(real_rid)
+        print(f"📢 HTTP 检测到开播！{room.url}")
+        return True
 
-            # 开始接收弹幕消息
-            while not stop_event.is_set():
-                msg = ws.recv()
-                if not msg:
+    live = asyncio.get_running_loop().create_future()
+
+    def on_live(msgs):
+        if not live.done():
+            live.set_result(True)
+
+    unsubscribe = conn.subscribe(("LIVE",), on_live)
+    print(f"📺 使用 WebSocket 监听开播：{room.url}")
+    checked = None  # 已查过当前状态的连接序号
+    try:
+        while not live.done():
+            if conn.up.is_set():
+                if checked != conn.connects:
+                    # 已在订阅 LIVE 之后查询，查询期间开播也不会漏掉
+                    checked = conn.connects
+                    if await get_live_poller().check(real_rid):
+                        print(f"📢 HTTP 检测到开播！{room.url}")
+                        return True
+                    continue
+                await wait_first(live, conn.down.wait())
+                continue
+            # 连接尚未建立或正在重连，期间用 HTTP 轮询兜底
+            poll = asyncio.ensure_future(get_live_poller().wait_live(real_rid))
+            try:
+                await wait_first(live, poll, conn.up.wait())
+            finally:
+                poll.cancel()
+            if poll.done() and not poll.cancelled():
+                print(f"📢 HTTP 检测到开播！{room.url}")
+                return True
+    finally:
+        unsubscribe()
+    print(f"📢 WebSocket 检测到开播！{room.url}")
+    return True
+
+class DanmakuFramer:
+    """
+    弹幕协议流式分帧：用 memoryview + struct.unpack_from 读包头，不为每个字段切片复制；
+    解压后的内层数据迭代处理（不递归），消息逐条惰性产出；
+    跨 WebSocket 消息被拆开的帧会暂存，等下一条消息到达后拼接。
+    指定 wanted 时先直接读出命令开头的 cmd 字段，不需要的命令（在线榜、进场、礼物刷屏等）不做 JSON 解析。
+    """
+
+    HEADER = struct.Struct(">IHHI")  # 数据包长度、头部长度、协议版本、操作码（序列号不需要）
+    MAX_PACKET = 16 * 1024 * 1024   # 超过此长度视为包头损坏，防止暂存区无限增长
+    CMD_PREFIX = b'{"cmd":'         # 服务端下发的命令都以 cmd 字段开头
+
+    def __init__(self):
+        self.pending = b""  # 上一条消息末尾不完整的帧
+        self.errors = 0     # 包头损坏、解压或 JSON 解析失败的次数
+        self.parsed = 0     # 完整解析的命令数
+        self.skipped = 0    # 按 cmd 跳过、未解析的命令数
+        self.heartbeat_reply_at = None  # 最近一次解析到心跳回复（op=3）的时间，由调用方取走
+
+    def reset(self):
+        """重连后丢弃上一条连接残留的半帧，计数保留"""
+        self.pending = b""
+        self.heartbeat_reply_at = None
+
+    @classmethod
+    def peek_cmd(cls, buf: bytes, start: int, end: int):
+        """不解析 JSON，直接读出开头的 cmd 字段（去掉 :4:0:2:2:2:0 之类的后缀）；格式不符时返回 None"""
+        if not buf.startswith(cls.CMD_PREFIX, start, end):
+            return None
+        start += len(cls.CMD_PREFIX)
+        if buf.startswith(b" ", start, end):
+            start += 1  # 兼容 "cmd": "..." 带空格的写法
+        if not buf.startswith(b'"', start, end):
+            return None
+        start += 1
+        stop = buf.find(b'"', start, end)
+        if stop < 0:
+            return None
+        colon = buf.find(b":", start, stop)
+        return buf[start:colon if colon >= 0 else stop].decode("ascii", "ignore")
+
+    def error(self, reason):
+        """记录一次解析错误，首个及之后每100个打印一次"""
+        self.errors += 1
+        if self.errors == 1 or self.errors % 100 == 0:
+            print(f"⚠️ 弹幕数据包解析失败（累计 {self.errors} 次）：{reason}")
+
+    def feed(self, data: bytes, wanted=None):
+        """喂入一条 WebSocket 消息，逐条产出其中的 JSON 命令；wanted 为需要的 cmd 集合，None 表示全部解析"""
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+        unpack_from = self.HEADER.unpack_from
+        # 待处理的 (数据, 偏移, 是否为最外层)；解压出的内层数据压栈处理完再回到外层
+        stack = [(memoryview(data), 0, True)]
+        while stack:
+            view, offset, outer = stack.pop()
+            end = len(view)
+            while offset + 16 <= end:
+                packet_len, header_len, ver, op = unpack_from(view, offset)
+                if header_len < 16 or packet_len < header_len or packet_len > self.MAX_PACKET:
+                    # 包头损坏（包括 packet_len 为 0），丢弃本段剩余数据，避免原地死循环
+                    self.error(f"非法包头 packet_len={packet_len} header_len={header_len}")
+                    offset = end
                     break
-                # 弹幕服务器可能将多条弹幕打包在一起发送，逐条解析
-                for sub_json in parse_ws_slices(msg if isinstance(msg, bytes) else msg.encode()):
-                    if sub_json.get("cmd") == "DANMU_MSG":
-                        text = sub_json["info"][1][1]  # 弹幕文本内容
-                        # 计算弹幕出现的相对时间（从录制开始算起）
-                        elapsed = datetime.now() - start_time
-                        mm, ss = divmod(elapsed.seconds, 60)
-                        ccc = int(elapsed.microseconds / 1000)
-                        start_ts = f"0:{mm:02d}:{ss:02d}.{ccc:03d}"
-                        end_time = elapsed + timedelta(seconds=5)
-                        emm, ess = divmod(end_time.seconds, 60)
-                        eccc = int(end_time.microseconds / 1000)
-                        end_ts = f"0:{emm:02d}:{ess:02d}.{eccc:03d}"
-                        # 将弹幕作为一行字幕写入 ASS 文件（5秒显示时间）
-                        line = f"Dialogue: 0,{start_ts},{end_ts},default,,0,0,0,,{text}\n"
-                        # 追加写入弹幕 ASS 文件
-                        with danmaku_path.open("a", encoding="utf-8") as f:
-                            f.write(line)
-            ws.close()
-        except Exception as e:
-            print(f"⚠️ 弹幕监听异常，将在5秒后重连: {e}")
-            time.sleep(5)
-            # 不 set stop_event，允许自动重连
+                if offset + packet_len > end:
+                    break  # 帧不完整
+                start, offset = offset + header_len, offset + packet_len
+                body = view[start:offset]
+                if op != 5:  # 只关心命令包（心跳回复、认证回复等跳过）
+                    if op == 3:
+                        self.heartbeat_reply_at = time.monotonic()
+                    continue
+                if ver == 2 or ver == 3:
+                    try:
+                        inflated = zlib.decompress(body) if ver == 2 else brotli.decompress(bytes(body))
+                    except Exception as e:
+                        self.error(f"ver={ver} 解压失败：{e}")
+                        continue
+                    stack.append((view, offset, outer))
+                    view, offset, end, outer = memoryview(inflated), 0, len(inflated), False
+                    continue
+                if wanted is not None:
+                    cmd = self.peek_cmd(view.obj, start, offset)
+                    if cmd is not None and cmd not in wanted:
+                        self.skipped += 1
+                        continue
+                try:
+                    msg = loads_json(body)
+                except Exception as e:
+                    self.error(f"JSON 解析失败：{e}")
+                    continue
+                self.parsed += 1
+                yield msg
+            if offset < end:
+                if outer:
+                    self.pending = bytes(view[offset:])  # 留到下一条消息拼接
+                else:
+                    self.error("解压后的数据末尾不完整")
+
+def loads_json(body) -> dict:
+    """解析一条命令的 JSON（bytes / memoryview），装有 orjson 时优先使用"""
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            pass  # 含非法 UTF-8 等情况，退回标准库按忽略错误的方式解码
+    return json.loads(str(body, "utf-8", "ignore"))
+
+def parse_ws_slices(blob: bytes) -> list:
+    """解析 WebSocket 数据包，提取可能包含的多条JSON消息"""
+    return list(DanmakuFramer().feed(blob))
+
+ASS_PLAY_RES = (1920, 1080)  # ASS 画布尺寸，压制时按视频实际分辨率缩放
+
+def write_ass_header(danmaku_path: Path):
+    """写入ASS弹幕文件头"""
+    danmaku_path.write_text(
+        "[Script Info]\n"
+        "ScriptType: v4.00+\n"
+        f"PlayResX: {ASS_PLAY_RES[0]}\n"
+        f"PlayResY: {ASS_PLAY_RES[1]}\n\n"
+        "[V4+ Styles]\n"
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, "
+        "OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, "
+        "ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+        "Alignment, MarginL, MarginR, MarginV, Encoding\n"
+        "Style: default,Arial,36,&H00FFFFFF,&H0000FFFF,&H00000000,&H00000000,"
+        "0,0,0,0,100,100,0,0,1,2,0,7,10,10,10,1\n"
+        f"Style: danmaku,Microsoft YaHei,{danmaku_font_size},&H20FFFFFF,&H20FFFFFF,&H80000000,&H00000000,"
+        "1,0,0,0,100,100,0,0,1,1.5,0,7,0,0,0,1\n\n"
+        "[Events]\n"
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n",
+        encoding="utf-8"
+    )
+
+def ass_time(seconds: float) -> str:
+    """秒数转 ASS 时间戳 H:MM:SS.cc（ASS 规范精确到百分之一秒，libass 会把三位小数当成百分秒）"""
+    cs = max(0, int(round(seconds * 100)))
+    h, cs = divmod(cs, 360000)
+    m, cs = divmod(cs, 6000)
+    s, cs = divmod(cs, 100)
+    return f"{h}:{m:02d}:{s:02d}.{cs:02d}"
+
+def parse_ass_time(ts: str) -> float:
+    """ASS 时间戳转秒数，兼容旧版本写入的三位小数"""
+    h, m, rest = ts.strip().split(":")
+    sec, _, frac = rest.partition(".")
+    return int(h) * 3600 + int(m) * 60 + int(sec) + (int(frac) / 10 ** len(frac) if frac else 0.0)
+
+def format_dialogue(text: str, elapsed: timedelta) -> str:
+    """将一条弹幕格式化为 ASS Dialogue 行（5秒显示时间）"""
+    start = elapsed.total_seconds()
+    return f"Dialogue: 0,{ass_time(start)},{ass_time(start + 5)},default,,0,0,0,,{text}\n"
+
+def ass_escape(text: str) -> str:
+    """转义弹幕文本中会被 ASS 当成特效标签或换行的字符"""
+    return text.replace("\\", "\\\u200b").replace("{", "\\{").replace("}", "\\}").replace("\n", " ")
+
+def merge_duplicates(events, window: float):
+    """
+    把 window 秒内文本相同的弹幕合并到第一条上：events 为按时间排序的 (秒, 文本, 颜色, 模式)，
+    按第一条的时间顺序产出 (秒, 文本, 颜色, 模式, 条数)，只缓存 window 秒内的弹幕。
+    """
+    pending = deque()  # 尚未产出的 [秒, 文本, 颜色, 模式, 条数]
+    active = {}        # 文本 -> pending 中仍可合并的那一条
+    for t, text, color, mode in events:
+        while pending and pending[0][0] + window < t:
+            e = pending.popleft()
+            if active.get(e[1]) is e:
+                del active[e[1]]
+            yield e
+        e = active.get(text)
+        if e is not None:
+            e[4] += 1
+            continue
+        e = [t, text, color, mode, 1]
+        active[text] = e
+        pending.append(e)
+    yield from pending
+
+class DanmakuLayout:
+    """
+    弹幕排布：滚动弹幕（模式 1）、顶部（5）、底部（4）各一套轨道，按时间顺序逐条分配，互不重叠。
+    每套轨道用两个小顶堆：空闲轨道按编号（优先靠上），忙碌轨道按空出时间，每条弹幕 O(log 轨道数)。
+    滚动弹幕匀速移动，同一轨道前一条的尾部完全进入画面后即可放下一条，永远不会追尾；
+    没有空闲轨道时最多推迟 danmaku_max_delay 秒，同屏超过 danmaku_max_on_screen 条时丢弃。
+    """
+
+    GAP = 20  # 同一轨道相邻滚动弹幕的最小间距（像素）
+
+    def __init__(self):
+        self.width, self.height = ASS_PLAY_RES
+        self.line_height = int(danmaku_font_size * 1.25)
+        self.tracks = max(1, int(self.height * danmaku_area) // self.line_height)
+        self.speed = self.width / danmaku_scroll_seconds  # 滚动速度（像素/秒）
+        self.free = {kind: list(range(self.tracks)) for kind in ("scroll", "top", "bottom")}
+        self.busy = {kind: [] for kind in ("scroll", "top", "bottom")}
+        self.on_screen = []  # 正在显示的弹幕的结束时间（小顶堆）
+        self.placed = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def text_width(self, text: str) -> int:
+        """估算文本宽度：ASCII 按半个字宽，其余按一个字宽"""
+        ascii_chars = len(text.encode("ascii", "ignore"))
+        return int((len(text) - ascii_chars * 0.5) * danmaku_font_size)
+
+    def place(self, t: float, text: str, color: int, mode: int):
+        """为一条弹幕分配轨道并返回 ASS Dialogue 行；放不下时返回 None"""
+        kind = "bottom" if mode == 4 else "top" if mode == 5 else "scroll"
+        free, busy, on_screen = self.free[kind], self.busy[kind], self.on_screen
+        while busy and busy[0][0] <= t:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        while on_screen and on_screen[0] <= t:
+            heapq.heappop(on_screen)
+        if danmaku_max_on_screen and len(on_screen) >= danmaku_max_on_screen:
+            self.dropped += 1
+            return None
+        if free:
+            track = heapq.heappop(free)
+        elif busy and busy[0][0] - t <= danmaku_max_delay:
+            t, track = heapq.heappop(busy)  # 推迟到最早空出的轨道
+        else:
+            self.dropped += 1
+            return None
+        width = self.text_width(text)
+        if kind == "scroll":
+            end = t + (self.width + width) / self.speed
+            ready = t + (width + self.GAP) / self.speed
+            y = track * self.line_height
+            x1 = self.width
+            if t < 0:  # 截取片段时起点之前出现的弹幕，从它在 0 秒时的位置开始移动
+                x1 -= int(-t * self.speed)
+            effect = f"\\move({x1},{y},{-width},{y})"
+        else:
+            end = ready = t + danmaku_fixed_seconds
+            if kind == "top":
+                effect = f"\\an8\\pos({self.width // 2},{track * self.line_height})"
+            else:
+                effect = f"\\an2\\pos({self.width // 2},{self.height - track * self.line_height})"
+        heapq.heappush(busy, (ready, track))
+        heapq.heappush(on_screen, end)
+        if end <= 0:
+            return None  # 截取片段起点前就已离开画面，只占轨道不输出
+        self.placed += 1
+        if color is not None and color != 0xFFFFFF:
+            effect += f"\\c&H{color & 0xFF:02X}{color >> 8 & 0xFF:02X}{color >> 16 & 0xFF:02X}&"
+        return f"Dialogue: 2,{ass_time(max(t, 0))},{ass_time(end)},danmaku,,0,0,0,,{{{effect}}}{ass_escape(text)}\n"
+
+    def layout(self, events):
+        """events 为按时间排序的 (秒, 文本, 颜色, 模式)，合并重复弹幕后逐条排布，产出 ASS Dialogue 行"""
+        if danmaku_merge_window > 0:
+            events = merge_duplicates(events, danmaku_merge_window)
+        else:
+            events = (e + (1,) for e in events)
+        for t, text, color, mode, n in events:
+            if n > 1:
+                self.merged += n - 1
+                text = f"{text} ×{n}"
+            line = self.place(t, text, color, mode)
+            if line is not None:
+                yield line
+
+MOVE_RE = re.compile(r"\\move\((-?\d+),(-?\d+),(-?\d+),(-?\d+)\)")
+
+def split_ass(danmaku_path: Path, ranges: list):
+    """
+    按时间段拆分 ASS：ranges 为 [(输出文件, 起始秒, 结束秒)]，
+    每个输出只保留与该段重叠的弹幕，时间平移到以段起点为 0；
+    跨越段起点的滚动弹幕从它在段起点时的位置开始移动，拼接处不会跳回右侧。
+    """
+    header, events = [], []
+    with danmaku_path.open(encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if line.startswith("Dialogue:"):
+                fields = line.split(",", 9)
+                events.append((parse_ass_time(fields[1]), parse_ass_time(fields[2]), fields))
+            elif not events:
+                header.append(line)
+    events.sort(key=lambda e: e[0])
+    starts = [e[0] for e in events]
+    longest = max((e[1] - e[0] for e in events), default=0.0)
+    for out, seg_start, seg_end in ranges:
+        lo = bisect.bisect_left(starts, seg_start - longest)
+        hi = bisect.bisect_left(starts, seg_end)
+        with out.open("w", encoding="utf-8") as f:
+            f.writelines(header)
+            for st, et, fields in events[lo:hi]:
+                if et <= seg_start:
+                    continue
+                if st < seg_start and "\\move(" in fields[9]:
+                    frac = (seg_start - st) / (et - st)
+                    fields = fields[:9] + [MOVE_RE.sub(
+                        lambda m: "\\move({},{},{},{})".format(
+                            round(int(m[1]) + (int(m[3]) - int(m[1])) * frac), m[2], m[3], m[4]), fields[9])]
+                f.write(",".join([fields[0], ass_time(st - seg_start), ass_time(et - seg_start)] + fields[3:]))
+
+# ========== 弹幕库 ==========
+class DanmakuStore:
+    """
+    弹幕库：每场录制一个 SQLite 文件（danmaku.db），只追加，按 ts_ms 建索引。
+    ts_ms 为录制开始后的毫秒数；ASS / JSON / XML 按需从库中导出，可任意截取时间段、平移时间。
+    """
+
+    COLUMNS = ("ts_ms", "uid", "uname", "cmd", "text", "color", "mode")
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS danmaku (
+            ts_ms INTEGER NOT NULL, uid INTEGER, uname TEXT, cmd TEXT, text TEXT, color INTEGER, mode INTEGER);
+        CREATE INDEX IF NOT EXISTS danmaku_ts ON danmaku (ts_ms);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = sqlite3.connect(str(path))  # 连接只能在创建它的线程中使用
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # WAL 下提交不逐次 fsync，由 checkpoint 落盘
+        self.db.executescript(self.SCHEMA)
+
+    def append(self, rows: list):
+        """批量追加 [(ts_ms, uid, uname, cmd, text, color, mode)]，一次提交"""
+        with self.db:
+            self.db.executemany("INSERT INTO danmaku VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def checkpoint(self):
+        """把 WAL 写回主文件并落盘"""
+        self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def set_meta(self, key: str, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def get_meta(self, key: str, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def query(self, start_ms: int = None, end_ms: int = None, cmds=("DANMU_MSG",), keyword: str = None):
+        """按时间段（库内时间，左闭右开）和命令类型查询，按时间顺序逐行返回"""
+        sql = "SELECT * FROM danmaku WHERE 1"
+        args = []
+        if start_ms is not None:
+            sql += " AND ts_ms >= ?"
+            args.append(start_ms)
+        if end_ms is not None:
+            sql += " AND ts_ms < ?"
+            args.append(end_ms)
+        if cmds:
+            sql += f" AND cmd IN ({','.join('?' * len(cmds))})"
+            args.extend(cmds)
+        if keyword:
+            sql += " AND text LIKE ?"
+            args.append(f"%{keyword}%")
+        return self.db.execute(sql + " ORDER BY ts_ms", args)
+
+    def timeline(self) -> "DanmakuTimeline":
+        return DanmakuTimeline(self.get_meta("timeline"))
+
+    def close(self):
+        self.db.close()
+
+class DanmakuTimeline:
+    """
+    库内时间与视频时间的对应：锚点 [(库内毫秒, 视频毫秒)]，每个锚点是一个分段收到第一块数据的时刻和它在合并视频中的起点，
+    锚点之间按原速平移。分段之间断档时收到的弹幕落到下一段的起点。没有锚点时两者相同。
+    """
+
+    def __init__(self, anchors=None):
+        anchors = sorted(anchors or [(0, 0)])
+        self.stores = [a[0] for a in anchors]
+        self.videos = [a[1] for a in anchors]
+
+    def to_video(self, ms: float) -> float:
+        i = max(0, bisect.bisect_right(self.stores, ms) - 1)
+        video = self.videos[i] + ms - self.stores[i]
+        if i + 1 < len(self.videos):
+            video = min(video, self.videos[i + 1])
+        return video
+
+    def to_store(self, ms: float) -> float:
+        i = max(0, bisect.bisect_right(self.videos, ms) - 1)
+        return self.stores[i] + ms - self.videos[i]
+
+    def to_video_array(self, ms: "np.ndarray") -> "np.ndarray":
+        """to_video 的向量化版本，一次换算整场弹幕的时间"""
+        stores = np.asarray(self.stores, dtype=np.float64)
+        videos = np.asarray(self.videos, dtype=np.float64)
+        i = np.maximum(np.searchsorted(stores, ms, side="right") - 1, 0)
+        limits = np.append(videos[1:], np.inf)  # 不超过下一段的起点
+        return np.minimum(videos[i] + ms - stores[i], limits[i])
+
+def danmaku_row(msg: dict, ts_ms: int):
+    """把一条弹幕 / 礼物 / 醒目留言命令转成弹幕库的一行，不认识的命令返回 None"""
+    cmd = msg.get("cmd", "").partition(":")[0]  # DANMU_MSG 可能带 :4:0:2:2:2:0 之类的后缀
+    if cmd == "DANMU_MSG":
+        info = msg["info"]
+        # info[0]: [_, 模式, 字号, 颜色, 发送时间, ...]；info[1]: 文本；info[2]: [uid, 用户名, ...]
+        return ts_ms, info[2][0], info[2][1], cmd, info[1], info[0][3], info[0][1]
+    data = msg.get("data") or {}
+    if cmd == "SEND_GIFT":
+        return ts_ms, data.get("uid"), data.get("uname"), cmd, f"{data.get('giftName')}×{data.get('num', 1)}", 0, 0
+    if cmd == "SUPER_CHAT_MESSAGE":
+        uname = (data.get("user_info") or {}).get("uname")
+        return ts_ms, data.get("uid"), uname, cmd, f"[¥{data.get('price')}] {data.get('message', '')}", 0, 0
+    return None
+
+def export_danmaku(db_path: Path, out_path: Path, fmt: str = "ass", start_s: float = 0, end_s: float = None):
+    """
+    从弹幕库导出视频时间 [start_s, end_s) 内的弹幕，时间平移到以 start_s 为 0：
+    ass 为可直接压制的字幕（danmaku_layout 开启时按轨道排布）；json 为逐条记录；
+    xml 为 B站弹幕格式（可用于各类播放器）。返回导出条数（ass 为实际显示的条数）。
+    """
+    store = DanmakuStore(db_path)
+    try:
+        timeline = store.timeline()
+        # ASS 弹幕有显示时长，起点前出现、仍在画面上的也要带上
+        lead = (2 * danmaku_scroll_seconds if danmaku_layout else 5) if fmt == "ass" else 0
+        start_ms = timeline.to_store((start_s - lead) * 1000) if start_s > lead else None
+        end_ms = timeline.to_store(end_s * 1000) if end_s is not None else None
+        cmds = ("DANMU_MSG",) if fmt != "json" else None
+
+        def rows():
+            for ts_ms, uid, uname, cmd, text, color, mode in store.query(start_ms, end_ms, cmds):
+                t = timeline.to_video(ts_ms) / 1000 - start_s
+                if t < -lead or (end_s is not None and t >= end_s - start_s):
+                    continue  # 视频开始前或截取范围外
+                yield t, uid, uname, cmd, text, color, mode
+
+        count = 0
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        if fmt == "ass":
+            write_ass_header(tmp)
+        with tmp.open("a" if fmt == "ass" else "w", encoding="utf-8") as f:
+            if fmt == "ass" and danmaku_layout:
+                layout = DanmakuLayout()
+                for line in layout.layout((r[0], r[4], r[5], r[6]) for r in rows()):
+                    f.write(line)
+                count = layout.placed
+                print(f"🧮 弹幕排布：显示 {layout.placed} 条，合并重复 {layout.merged} 条，丢弃 {layout.dropped} 条")
+            elif fmt == "ass":
+                for t, uid, uname, cmd, text, color, mode in rows():
+                    f.write(format_dialogue(text, timedelta(seconds=t)))
+                    count += 1
+            elif fmt == "xml":
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n<i>\n')
+                for t, uid, uname, cmd, text, color, mode in rows():
+                    f.write(f'<d p="{t:.3f},{mode or 1},25,{color or 16777215},0,0,{uid},0">{escape(text)}</d>\n')
+                    count += 1
+                f.write("</i>\n")
+            else:
+                f.write("[")
+                for t, uid, uname, cmd, text, color, mode in rows():
+                    row = {"time": round(t, 3), "uid": uid, "uname": uname, "cmd": cmd, "text": text,
+                           "color": color, "mode": mode}
+                    f.write(("," if count else "") + "\n" + json.dumps(row, ensure_ascii=False))
+                    count += 1
+                f.write("\n]\n")
+        os.replace(tmp, out_path)
+        return count
+    finally:
+        store.close()
+
+def finalize_danmaku(db_path: Path, ass_path: Path, anchors: list) -> int:
+    """记录弹幕与视频的时间对应关系，并导出整场的 ASS，返回导出条数"""
+    store = DanmakuStore(db_path)
+    try:
+        store.set_meta("timeline", anchors)
+    finally:
+        store.close()
+    return export_danmaku(db_path, ass_path, "ass")
+
+def search_danmaku(keyword: str, root: str = None, uid: int = None, limit: int = 100):
+    """在 root（默认保存目录）下所有录制的弹幕库中搜索文本，返回 [(录制文件夹, 视频秒数, 用户名, 文本)]"""
+    results = []
+    for db_path in sorted(Path(root or save_dir).glob("*/danmaku.db")):
+        store = DanmakuStore(db_path)
+        try:
+            timeline = store.timeline()
+            for ts_ms, row_uid, uname, cmd, text, color, mode in store.query(cmds=None, keyword=keyword):
+                if uid is None or row_uid == uid:
+                    results.append((db_path.parent.name, timeline.to_video(ts_ms) / 1000, uname, text))
+                    if len(results) >= limit:
+                        return results
         finally:
-            print("🛑 弹幕监听线程停止")
-    # 只在 stop_event.set() 被主流程调用时才彻底退出
+            store.close()
+    return results
+
+class DanmakuWriter:
+    """弹幕写库线程：接收循环只把行放进有界队列，由独立线程按行数/时间批量写入弹幕库"""
+
+    _STOP = object()  # 队列中的结束标记
+
+    def __init__(self, path: Path, meta: dict = None):
+        self.path = path
+        self.meta = meta or {}  # 启动时写入库的元数据（房间号、标题、开始时间等）
+        self.queue = queue.Queue(maxsize=danmaku_queue_size)
+        self.thread = threading.Thread(target=self.run, name=f"danmaku-writer-{path.parent.name}", daemon=True)
+        self.written = 0   # 已写入条数
+        self.dropped = 0   # 队列满被丢弃的条数
+        self.delayed = 0   # 在队列里等待超过两倍写盘间隔的条数
+        self.failed = 0    # 写库出错（磁盘满、SQLite 错误等）丢失的条数
+        self.last_drop_warn = 0.0
+        self.last_fail_warn = 0.0
+
+    def start(self):
+        """启动写库线程"""
+        self.thread.start()
+
+    def put(self, row: tuple) -> bool:
+        """放入一行弹幕（见 danmaku_row），不阻塞；队列满时丢弃并返回 False"""
+        try:
+            self.queue.put_nowait((time.monotonic(), row))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            now = time.monotonic()
+            if now - self.last_drop_warn > 10:  # 最多每10秒提示一次
+                self.last_drop_warn = now
+                print(f"⚠️ 弹幕写盘跟不上，已丢弃 {self.dropped} 条：{self.path}")
+            return False
+
+    def close(self, timeout: float = 30):
+        """写完队列中剩余的弹幕后停止线程（阻塞，事件循环中请用 asyncio.to_thread 调用）"""
+        if not self.thread.is_alive():
+            return  # 线程已退出（如打不开弹幕库），队列不会再被取走，放结束标记会一直阻塞
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            print(f"⚠️ 弹幕写库线程无响应，放弃等待：{self.path}")
+            return
+        self.thread.join(timeout)
+
+    def stats(self) -> dict:
+        """写入统计：已写、丢弃、延迟条数及当前队列深度"""
+        return {"written": self.written, "dropped": self.dropped, "delayed": self.delayed,
+                "failed": self.failed, "queue_depth": self.queue.qsize()}
+
+    def write_failed(self, count: int, e: Exception):
+        """记录一次写库失败：这批弹幕丢弃，线程继续取队列，最多每10秒提示一次"""
+        self.failed += count
+        now = time.monotonic()
+        if now - self.last_fail_warn > 10:
+            self.last_fail_warn = now
+            print(f"❌ 弹幕写库失败，已丢失 {self.failed} 条：{self.path}：{e}")
+
+    def run(self):
+        """写库线程主循环：攒批提交，按间隔 checkpoint 落盘（SQLite 连接只在本线程使用）"""
+        batch = []
+        last_flush = last_fsync = time.monotonic()
+        try:
+            store = DanmakuStore(self.path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"❌ 弹幕库打开失败，本场弹幕不会保存：{self.path}：{e}")
+            return
+        try:
+            try:
+                for key, value in self.meta.items():
+                    store.set_meta(key, value)
+            except (sqlite3.Error, OSError) as e:
+                print(f"⚠️ 弹幕库元数据写入失败：{e}")
+            stopping = False
+            while not stopping:
+                try:
+                    item = self.queue.get(timeout=max(0.0, last_flush + danmaku_flush_interval - time.monotonic()))
+                except queue.Empty:
+                    item = None
+                # 一次尽量多取，减少加锁和唤醒次数
+                while item is not None:
+                    if item is self._STOP:
+                        stopping = True
+                        break
+                    enqueued, row = item
+                    batch.append(row)
+                    if time.monotonic() - enqueued > 2 * danmaku_flush_interval:
+                        self.delayed += 1
+                    if len(batch) >= danmaku_flush_lines:
+                        break
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+                now = time.monotonic()
+                if batch and (stopping or len(batch) >= danmaku_flush_lines or now - last_flush >= danmaku_flush_interval):
+                    try:
+                        store.append(batch)
+                        self.written += len(batch)
+                    except (sqlite3.Error, OSError) as e:
+                        self.write_failed(len(batch), e)
+                    batch.clear()
+                    last_flush = now
+                    if stopping or now - last_fsync >= danmaku_fsync_interval:
+                        try:
+                            store.checkpoint()
+                        except (sqlite3.Error, OSError) as e:
+                            print(f"⚠️ 弹幕库 checkpoint 失败：{e}")
+                        last_fsync = now
+                elif not batch:
+                    last_flush = now
+        finally:
+            store.close()
+
+DANMAKU_CMDS = ("DANMU_MSG", "SEND_GIFT", "SUPER_CHAT_MESSAGE")  # 写入弹幕库的命令
 
-def record_stream(real_rid: str):
-    """开始录制直播流：网络断开自动重连；下播或超时停止录制"""
-    global stop_recording_flag
-    stop_recording_flag = False
+async def danmu_listener(real_rid: str, writer: DanmakuWriter, start_time: datetime, stop_event: asyncio.Event,
+                         conn: RoomEventConnection = None):
+    """订阅房间弹幕连接上的弹幕、礼物、醒目留言，交给写库线程写入弹幕库，直到 stop_event 被设置；未传入连接时自建一条"""
+    own = conn is None
+    if own:
+        conn = RoomEventConnection(real_rid).start()
+    start_ts = start_time.timestamp()
+
+    def on_danmaku(msgs):
+        # 计算弹幕出现的相对时间（从录制开始算起的毫秒），同一条消息里的弹幕时间相同
+        # 只放进写盘队列，接收循环不等待磁盘
+        ts_ms = int((time.time() - start_ts) * 1000)
+        for msg in msgs:
+            try:
+                row = danmaku_row(msg, ts_ms)
+            except (KeyError, IndexError, TypeError):
+                continue  # 字段不全的命令跳过
+            if row is not None:
+                writer.put(row)
+        metrics.inc("recorder_danmaku_ingest_total", len(msgs), room=real_rid)
+
+    unsubscribe = conn.subscribe(DANMAKU_CMDS, on_danmaku)
+    try:
+        await stop_event.wait()
+    finally:
+        unsubscribe()
+        if own:
+            await conn.close()
+    print("🛑 弹幕监听任务停止")
+
+async def run_cmd(cmd: list) -> int:
+    """异步运行外部命令（streamlink / ffmpeg），返回退出码"""
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    try:
+        return await proc.wait()
+    except asyncio.CancelledError:
+        proc.terminate()
+        raise
+
+async def wait_first_byte(path: Path, poll: float = 0.2) -> float:
+    """等到文件写入第一块数据，返回当时的时间戳（用于统计 streamlink 分段之间的断档）"""
+    while not path.exists() or path.stat().st_size == 0:
+        await asyncio.sleep(poll)
+    return time.time()
+
+# ========== 录制日志 ==========
+class SessionJournal:
+    """
+    录制日志：每场录制的文件夹下一个 session.json，记录分段、直播信息、已完成的处理步骤和输出文件。
+    每次更新都整体原子替换，进程中断后重启时据此从最后完成的步骤继续。
+    """
+    STAGES = ("recording", "merge", "danmaku", "postprocess", "highlights", "archive")  # 依次完成的步骤
+    MAX_ATTEMPTS = 3  # 续处理多少次仍失败就不再自动重试
+
+    def __init__(self, path: Path, data: dict):
+        self.path = path
+        self.data = data
+
+    @classmethod
+    def create(cls, ts_dir: Path, **info) -> "SessionJournal":
+        """新建一场录制的日志，info 为房间、标题、开始时间等直播信息"""
+        data = {"version": 1, **info, "parts": [], "merged": [], "merged_end": 0.0, "merged_bytes": 0,
+                "stages": {}, "files": {}, "outputs": {}, "archived": {}, "attempts": 0}
+        journal = cls(ts_dir / "session.json", data)
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, path: Path) -> "SessionJournal":
+        return cls(path, json.loads(path.read_text(encoding="utf-8")))
+
+    @property
+    def ts_dir(self) -> Path:
+        return self.path.parent
+
+    @property
+    def finished(self) -> bool:
+        return self.done(self.STAGES[-1])
+
+    def save(self):
+        write_text_atomic(self.path, json.dumps(self.data, ensure_ascii=False, indent=1))
+
+    def update(self, **fields):
+        self.data.update(fields)
+        self.save()
+
+    def done(self, stage: str) -> bool:
+        return stage in self.data["stages"]
+
+    def mark(self, stage: str, **fields):
+        """记录某个步骤已完成"""
+        self.data["stages"][stage] = time.time()
+        self.update(**fields)
+
+    def add_part(self, segment: Path, started: float = None):
+        """记录一个有效分段及其收到第一块数据的时间"""
+        self.data["parts"].append({"file": segment.name, "started": started})
+        self.save()
+
+    def add_merged(self, segment: Path, offset: float, end: float, size: int):
+        """记录一个分段已追加到增量合并文件：在合并文件中的起点、合并后的总时长和文件大小"""
+        self.data["merged"].append({"file": segment.name, "offset": offset})
+        self.update(merged_end=end, merged_bytes=size)
+
+    def parts(self) -> list:
+        return [self.ts_dir / p["file"] for p in self.data["parts"]]
+
+    def recover_parts(self) -> list:
+        """
+        录制中途进程退出时，最后一段还没来得及记入日志：把目录中未记录的有效分段（>1MB）按文件名顺序补上，
+        开始时间未知记为 None；返回补上的分段。
+        """
+        listed = {p["file"] for p in self.data["parts"]}
+        found = sorted(path for pattern in ("*.ts", "*.flv") for path in self.ts_dir.glob(pattern)
+                       if path.name != "merged.ts" and path.name not in listed and path.stat().st_size > 1_048_576)
+        for segment in found:
+            self.add_part(segment)
+        return found
+
+    def output(self, key: str, name: str) -> Path:
+        """保存目录下的输出文件；文件名首次确定后记入日志，续处理时沿用同一个文件名"""
+        files = self.data["files"]
+        if key not in files:
+            files[key] = name
+            self.save()
+        return self.ts_dir.parent / files[key]
+
+# ========== 后期处理 ==========
+MP4_VIDEO_CODECS = {"h264", "hevc"}  # 可直接封装进 MP4 的视频编码
+MP4_AUDIO_CODECS = {"aac", "mp3"}    # 可直接封装进 MP4 的音频编码
+
+async def probe_codecs(path: Path):
+    """用 ffprobe 读取视频、音频编码名，失败时返回 (None, None)"""
+    codecs = {}
+    for kind in ("v", "a"):
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", f"{kind}:0",
+            "-show_entries", "stream=codec_name", "-of", "csv=p=0", str(path),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        out, _ = await proc.communicate()
+        name = out.decode(errors="ignore").strip()
+        codecs[kind] = name if proc.returncode == 0 and name else None
+    return codecs["v"], codecs["a"]
+
+async def probe_duration(path: Path):
+    """用 ffprobe 读取媒体时长（秒），失败时返回 None"""
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(path),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    out, _ = await proc.communicate()
+    try:
+        return float(out.decode(errors="ignore").strip()) if proc.returncode == 0 else None
+    except ValueError:
+        return None
+
+def can_remux(vcodec: str, acodec: str) -> bool:
+    """音视频编码是否可以直接封装进 MP4（不重新编码）"""
+    return vcodec in MP4_VIDEO_CODECS and (acodec is None or acodec in MP4_AUDIO_CODECS)
+
+def ffmpeg_filter_path(path: Path) -> str:
+    """把文件路径转义成 ffmpeg 滤镜参数可用的形式（兼容 Windows 盘符和反斜杠）"""
+    escaped = path.as_posix().replace(":", "\\:").replace("'", "'\\''")
+    return f"'{escaped}'"
+
+def has_dialogue(danmaku_path: Path) -> bool:
+    """ASS 文件中是否有弹幕行"""
+    if not danmaku_path.exists():
+        return False
+    with danmaku_path.open(encoding="utf-8", errors="ignore") as f:
+        return any(line.startswith("Dialogue:") for line in f)
+
+async def run_ffmpeg(args: list, phase: str = "ffmpeg"):
+    """
+    运行 ffmpeg（自动加 -benchmark），stderr 照常输出到终端，耗时按 phase 计入运行指标，
+    返回 (退出码, {"wall_s": 墙钟时间, "cpu_s": 用户态+内核态 CPU 时间})
+    """
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y", "-hide_banner", "-benchmark", *args, stderr=asyncio.subprocess.PIPE
+    )
+    cpu_s = None
+    tail = b""
+    try:
+        while True:
+            chunk = await proc.stderr.read(4096)
+            if not chunk:
+                break
+            sys.stderr.buffer.write(chunk)
+            sys.stderr.flush()
+            tail = (tail + chunk)[-4096:]
+            # ffmpeg 结束时输出：bench: utime=1.234s stime=0.567s rtime=2.345s
+            m = re.search(rb"bench: utime=([\d.]+)s stime=([\d.]+)s", tail)
+            if m:
+                cpu_s = float(m.group(1)) + float(m.group(2))
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        proc.terminate()
+        raise
+    wall_s = time.monotonic() - started
+    metrics.observe("recorder_ffmpeg_phase_seconds", wall_s, phase=phase)
+    if cpu_s is not None:
+        metrics.observe("recorder_ffmpeg_phase_cpu_seconds", cpu_s, phase=phase)
+    metrics.inc("recorder_ffmpeg_runs_total", phase=phase, ok=str(returncode == 0).lower())
+    return returncode, {"wall_s": round(wall_s, 1), "cpu_s": round(cpu_s, 1) if cpu_s is not None else None}
+
+async def encode_with_danmu_parallel(merged_ts: Path, danmaku_file: Path, final_video: Path, workers: int):
+    """
+    分段并行压制带弹幕版本：在关键帧处把合并 TS 无损切成若干段，按段平移弹幕时间，
+    多个 ffmpeg 同时压制画面，最后无损拼接并配上原始音轨。
+    返回 (是否成功, {"wall_s": 总墙钟时间, "cpu_s": 所有进程 CPU 时间之和})。
+    """
+    started = time.monotonic()
+    chunk_dir = danmaku_file.parent / "chunks"
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    chunk_dir.mkdir(parents=True)
+    chunk_csv = chunk_dir / "chunks.csv"
+    cpu = []
+
+    def result(ok: bool):
+        return ok, {"wall_s": round(time.monotonic() - started, 1),
+                    "cpu_s": round(sum(c for c in cpu if c is not None), 1)}
+
+    # 1) 按关键帧无损切段（segment 复用器只会在关键帧处切开），记录每段的起止时间
+    returncode, stats = await run_ffmpeg([
+        "-i", str(merged_ts), "-map", "0:v", "-c", "copy", "-f", "segment",
+        "-segment_time", str(parallel_chunk_seconds), "-reset_timestamps", "1",
+        "-segment_list", str(chunk_csv), "-segment_list_type", "csv", str(chunk_dir / "%05d.ts")
+    ], phase="chunk_split")
+    cpu.append(stats["cpu_s"])
+    if returncode != 0:
+        return result(False)
+    chunks = []
+    for line in chunk_csv.read_text(encoding="utf-8").splitlines():
+        name, seg_start, seg_end = line.rsplit(",", 2)
+        chunks.append((chunk_dir / Path(name).name, float(seg_start), float(seg_end)))
+
+    # 2) 每段一份平移后的弹幕：拆分整场排布好的 ASS，各段的轨道与整场一致，拼接处弹幕不跳轨
+    await asyncio.to_thread(split_ass, danmaku_file, [(c.with_suffix(".ass"), st, et) for c, st, et in chunks])
+
+    # 3) 多个 ffmpeg 并行压制，平分 CPU 线程
+    slots = asyncio.Semaphore(workers)
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+
+    async def encode_chunk(chunk: Path):
+        async with slots:
+            burn = f"subtitles=filename={ffmpeg_filter_path(chunk.with_suffix('.ass'))}"
+            return await run_ffmpeg([
+                "-i", str(chunk), "-filter_complex", f"[0:v]{burn}[danmu]", "-map", "[danmu]",
+                "-c:v", "libx264", "-threads", threads, str(chunk.with_name(f"{chunk.stem}_out.ts"))
+            ], phase="chunk_encode")
+
+    encoded = await asyncio.gather(*(encode_chunk(c) for c, _, _ in chunks))
+    cpu.extend(stats["cpu_s"] for _, stats in encoded)
+    if any(returncode != 0 for returncode, _ in encoded):
+        return result(False)
+
+    # 4) 无损拼接压制好的画面，音轨取自原始合并文件
+    list_file = chunk_dir / "encoded.txt"
+    list_file.write_text("".join(f"file '{c.with_name(f'{c.stem}_out.ts').as_posix()}'\n" for c, _, _ in chunks),
+                         encoding="utf-8")
+    returncode, stats = await run_ffmpeg([
+        "-f", "concat", "-safe", "0", "-i", str(list_file), "-i", str(merged_ts),
+        "-map", "0:v", "-map", "1:a?", "-c:v", "copy", "-c:a", "aac", "-movflags", "+faststart", str(final_video)
+    ], phase="chunk_concat")
+    cpu.append(stats["cpu_s"])
+    if returncode == 0:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    return result(returncode == 0)
+
+async def postprocess(merged_ts: Path, danmaku_file: Path, no_danmu_video: Path, final_video: Path,
+                      skip=()) -> dict:
+    """
+    由合并后的 TS 生成无弹幕、带弹幕（压制）两个 MP4，源视频只解码一次：
+    - 源编码可直接封装进 MP4 时，无弹幕版本只做 -c copy 转封装，与带弹幕压制并行；
+    - 否则用一个 ffmpeg 进程 split 解码结果，同时编码两个输出；
+    - 开启 parallel_encode_workers 时，带弹幕版本改为分段并行压制。
+    skip 为已经生成过的输出文件名（续处理时跳过）。
+    返回每个输出的耗时统计 {文件名: {"mode", "wall_s", "cpu_s", "ok"}}。
+    """
+    vcodec, acodec = await probe_codecs(merged_ts)
+    remux_ok = can_remux(vcodec, acodec)
+    with_plain = no_danmu_video.name not in skip
+    with_danmu = final_video.name not in skip and has_dialogue(danmaku_file)
+    parallel = parallel_encode_workers > 1
+    encode = ["-c:v", "libx264", "-c:a", "aac"]
+    burn = f"subtitles=filename={ffmpeg_filter_path(danmaku_file)}"
+    report = {}
+
+    async def remux():
+        returncode, stats = await run_ffmpeg([
+            "-i", str(merged_ts), "-map", "0:v", "-map", "0:a?", "-c", "copy",
+            "-movflags", "+faststart", str(no_danmu_video)
+        ], phase="remux")
+        report[no_danmu_video.name] = {"mode": "remux", **stats, "ok": returncode == 0}
+
+    async def plain_encode():
+        returncode, stats = await run_ffmpeg(["-i", str(merged_ts), *encode, str(no_danmu_video)], phase="encode")
+        report[no_danmu_video.name] = {"mode": "encode", **stats, "ok": returncode == 0}
+
+    async def burn_in():
+        if parallel:
+            ok, stats = await encode_with_danmu_parallel(merged_ts, danmaku_file, final_video, parallel_encode_workers)
+            report[final_video.name] = {"mode": f"parallel×{parallel_encode_workers}", **stats, "ok": ok}
+            return
+        returncode, stats = await run_ffmpeg([
+            "-i", str(merged_ts), "-filter_complex", f"[0:v]{burn}[danmu]",
+            "-map", "[danmu]", "-map", "0:a?", *encode, str(final_video)
+        ], phase="burn_in")
+        report[final_video.name] = {"mode": "encode", **stats, "ok": returncode == 0}
+
+    if remux_ok and with_plain:
+        print(f"⚡ 源编码 {vcodec}/{acodec} 可直接封装，无弹幕版本走转封装")
+    if remux_ok or parallel or not with_plain or not with_danmu:
+        await asyncio.gather(*([remux() if remux_ok else plain_encode()] if with_plain else []),
+                             *([burn_in()] if with_danmu else []))
+    else:
+        # 解码一次，split 成两路分别编码
+        returncode, stats = await run_ffmpeg([
+            "-i", str(merged_ts), "-filter_complex", f"[0:v]split=2[plain][src];[src]{burn}[danmu]",
+            "-map", "[plain]", "-map", "0:a?", *encode, str(no_danmu_video),
+            "-map", "[danmu]", "-map", "0:a?", *encode, str(final_video),
+        ], phase="shared")
+        for out in (no_danmu_video, final_video):
+            report[out.name] = {"mode": "shared", **stats, "ok": returncode == 0}
+
+    for name, r in report.items():
+        mark = "✅" if r["ok"] else "❌"
+        await notify(f"{mark} {name}（{r['mode']}）墙钟 {r['wall_s']}s，CPU {r['cpu_s']}s")
+    return report
+
+class IncrementalMerger:
+    """
+    边录边合并：每个分段结束后立刻转封装为 MPEG-TS 追加到同一个文件，
+    时间戳按已合并时长顺延。下播时只需等最后一段追加完，不再整体重读重写；
+    TS 可以边写边播，录制途中就能观看已合并的部分。
+    """
+
+    def __init__(self, path: Path, journal: SessionJournal = None):
+        self.path = path
+        self.journal = journal  # 录制日志（可选），每追加一段记录一次进度
+        self.offset = 0.0   # 已合并内容的总时长（秒），作为下一段的时间戳偏移
+        self.merged = []    # 已追加的分段
+        self.offsets = []   # 各分段在合并文件中的起点（秒），与 merged 一一对应
+        self.failed = False
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def resume(self):
+        """按录制日志恢复合并进度：截掉中断时写了一半的内容，日志中尚未合并的分段重新排队"""
+        data = self.journal.data
+        self.merged = [self.path.parent / m["file"] for m in data["merged"]]
+        self.offsets = [m["offset"] for m in data["merged"]]
+        self.offset = data["merged_end"]
+        self.failed = data.get("merge_failed", False) or (bool(self.merged) and not self.path.exists())
+        if self.path.exists() and self.path.stat().st_size > data["merged_bytes"]:
+            with self.path.open("r+b") as f:
+                f.truncate(data["merged_bytes"])
+        for part in self.journal.parts():
+            if part not in self.merged and part.exists():
+                self.submit(part)
+
+    def submit(self, segment: Path):
+        """提交一个已结束的分段，在后台按顺序追加，不阻塞录制循环"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        self.queue.put_nowait(segment)
+
+    async def run(self):
+        while True:
+            segment = await self.queue.get()
+            if segment is None:
+                return
+            if not self.failed and not await self.append(segment):
+                self.failed = True  # 之后不再追加，下播时退回整体合并
+                print(f"⚠️ 增量合并失败，下播后改为整体合并：{segment}")
+                if self.journal is not None:
+                    self.journal.update(merge_failed=True)
+
+    async def append(self, segment: Path) -> bool:
+        """把一个分段转封装后追加到合并文件末尾，失败时截断回追加前的大小"""
+        started = time.monotonic()
+        duration = await probe_duration(segment)
+        if duration is None:
+            return False
+        size = self.path.stat().st_size if self.path.exists() else 0
+        with self.path.open("ab") as out:
+            proc = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", str(segment),
+                "-map", "0:v?", "-map", "0:a?", "-c", "copy",
+                "-output_ts_offset", f"{self.offset:.3f}", "-f", "mpegts", "pipe:1",
+                stdout=out
+            )
+            if await proc.wait() != 0:
+                out.truncate(size)
+                return False
+        metrics.observe("recorder_ffmpeg_phase_seconds", time.monotonic() - started, phase="merge_append")
+        self.offsets.append(self.offset)
+        self.offset += duration
+        self.merged.append(segment)
+        if self.journal is not None:
+            self.journal.add_merged(segment, self.offsets[-1], self.offset, self.path.stat().st_size)
+        return True
+
+    async def finish(self) -> bool:
+        """等待尚未追加的分段完成，返回是否所有分段都已增量合并"""
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+        return not self.failed and bool(self.merged)
+
+# ========== 进程内拉流 ==========
+def get_stream_urls(real_rid: str) -> list:
+    """获取直播流地址，返回 [(地址, "flv" 或 "hls")]，FLV 优先；未开播或失败时返回空列表"""
+    params = {"room_id": real_rid, "protocol": "0,1", "format": "0,1,2", "codec": "0,1",
+              "qn": stream_qn, "platform": "web", "ptype": 8}
+    try:
+        resp = api_client.get_json("/xlive/web-room/v2/index/getRoomPlayInfo", params)
+        if resp.get("code") != 0:
+            return []
+        playurl = ((resp["data"].get("playurl_info") or {}).get("playurl") or {})
+        urls = []
+        for stream in playurl.get("stream", []):
+            for fmt in stream.get("format", []):
+                kind = "flv" if fmt.get("format_name") == "flv" else "hls"
+                for codec in fmt.get("codec", []):
+                    for info in codec.get("url_info", []):
+                        urls.append((f"{info['host']}{codec['base_url']}{info.get('extra', '')}", kind))
+        # FLV 一条连接即可拉完整段，优先使用
+        return sorted(urls, key=lambda u: u[1] != "flv")
+    except Exception as e:
+        print(f"⚠️ 获取直播流地址失败: {e}")
+    return []
+
+class NativeFetcher:
+    """
+    进程内拉流：共用 aiohttp 连接池（断线重连时复用 TCP/TLS 连接），
+    每次连接写一个分段，数据边收边写盘；记录每次重连前后的断档时长。
+    """
+
+    CHUNK = 64 * 1024
+    HLS_STALL_TARGETS = 3  # HLS 播放列表连续多少个分片时长没有新分片就结束本段
+
+    def __init__(self, real_rid: str):
+        self.real_rid = real_rid
+        self.last_byte_at = None  # 上一段最后收到数据的时间（monotonic）
+        self.first_byte_wall = None  # 当前分段收到第一块数据的时间（time.time()），用于对齐弹幕时间
+        self.gaps = []            # 每次重连的断档时长（秒）
+
+    def on_first_byte(self):
+        """新连接收到第一块数据时，记录与上一段之间的断档"""
+        self.first_byte_wall = time.time()
+        if self.last_byte_at is not None:
+            gap = time.monotonic() - self.last_byte_at
+            self.gaps.append(gap)
+            metrics.observe("recorder_segment_gap_seconds", gap, room=self.real_rid)
+            print(f"🔁 [{self.real_rid}] 续录成功，断档 {gap:.2f}s")
+
+    async def fetch_segment(self, stem: Path):
+        """解析最新地址并拉流到 stem 同名文件，直到断开；返回写入的文件（没拉到数据时为 None）"""
+        urls = await asyncio.to_thread(get_stream_urls, self.real_rid)
+        for url, kind in urls:
+            path = stem.with_suffix(".flv" if kind == "flv" else ".ts")
+            try:
+                if kind == "flv":
+                    await self.pull_flv(url, path)
+                else:
+                    await self.pull_hls(url, path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ [{self.real_rid}] 拉流中断: {e}")
+            if path.exists() and path.stat().st_size > 0:
+                return path
+        return None
+
+    def headers(self) -> dict:
+        headers = {"Referer": "https://live.bilibili.com/"}
+        headers.update(get_cookie_header())
+        return headers
+
+    async def pull_flv(self, url: str, path: Path):
+        """HTTP-FLV：一条长连接，收到的数据块直接写盘"""
+        timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=15)
+        async with get_http_session().get(url, headers=self.headers(), timeout=timeout) as resp:
+            resp.raise_for_status()
+            with path.open("wb") as f:
+                first = True
+                async for chunk in resp.content.iter_chunked(self.CHUNK):
+                    if first:
+                        self.on_first_byte()
+                        first = False
+                    f.write(chunk)
+                    self.last_byte_at = time.monotonic()
+
+    async def pull_hls(self, url: str, path: Path):
+        """
+        HLS：轮询播放列表，按媒体序号拉取新分片依次追加到同一文件，直到列表结束或出错；
+        列表连续 HLS_STALL_TARGETS 个分片时长没有新分片（CDN 缓存过期内容、下播后没写 ENDLIST）时也返回。
+        """
+        timeout = aiohttp.ClientTimeout(sock_connect=5, sock_read=15)
+        session = get_http_session()
+        headers = self.headers()
+        last_seq = None
+        last_new_at = time.monotonic()  # 最近一次出现新分片的时间
+        init_written = False
+        first = True
+        with path.open("wb") as f:
+            while True:
+                async with session.get(url, headers=headers, timeout=timeout) as resp:
+                    resp.raise_for_status()
+                    playlist = await resp.text()
+                seq = 0
+                target = 1.0
+                segments = []
+                init_uri = None
+                for line in playlist.splitlines():
+                    line = line.strip()
+                    if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                        seq = int(line.split(":", 1)[1])
+                    elif line.startswith("#EXT-X-TARGETDURATION:"):
+                        target = float(line.split(":", 1)[1])
+                    elif line.startswith("#EXT-X-MAP:"):
+                        m = re.search(r'URI="([^"]+)"', line)
+                        init_uri = m.group(1) if m else None
+                    elif line and not line.startswith("#"):
+                        segments.append((seq, line))
+                        seq += 1
+                if init_uri and not init_written:
+                    segments.insert(0, (None, init_uri))  # fMP4 初始化分片只写一次
+                    init_written = True
+                for n, uri in segments:
+                    if n is not None and last_seq is not None and n <= last_seq:
+                        continue  # 已经拉过
+                    async with session.get(urljoin(url, uri), headers=headers, timeout=timeout) as seg:
+                        seg.raise_for_status()
+                        async for chunk in seg.content.iter_chunked(self.CHUNK):
+                            if first:
+                                self.on_first_byte()
+                                first = False
+                            f.write(chunk)
+                            self.last_byte_at = time.monotonic()
+                    if n is not None:
+                        last_seq = n
+                        last_new_at = time.monotonic()
+                if "#EXT-X-ENDLIST" in playlist:
+                    return
+                if time.monotonic() - last_new_at > self.HLS_STALL_TARGETS * target:
+                    print(f"⚠️ [{self.real_rid}] HLS 播放列表 {self.HLS_STALL_TARGETS * target:.0f}s 没有新分片，重新获取直播地址")
+                    return
+                await asyncio.sleep(max(0.2, target / 2))
+
+async def record_stream(room: Room, conn: RoomEventConnection = None):
+    """开始录制直播流：网络断开自动重连；下播或超时停止录制。conn 为房间的常驻弹幕连接（可选）"""
+    real_rid = room.real_rid
+    stop_recording = False  # 收到下播通知或超时需停止录制
 
     # 获取当前直播标题用于文件名（可选）
-    raw_title = get_live_title(real_rid)
+    raw_title = await asyncio.to_thread(get_live_title, real_rid)
     if not raw_title:
         # 如果没有获取到标题，就使用 prefix（去掉末尾下划线）代替
-        raw_title = prefix.rstrip("_")
+        raw_title = room.prefix.rstrip("_")
     # 准备本次录制文件的前缀（包含主播名、直播标题、日期）
     date_str = datetime.now().strftime("%m月%d号")
-    session_prefix = f"{prefix}{raw_title}_{date_str}_"
+    session_prefix = f"{room.prefix}{raw_title}_{date_str}_"
 
     # 获取 SESSDATA（如有）用于 streamlink 请求
     sess = get_sessdata_from_cookie()
     cookie_args = ["--http-cookie", f"SESSDATA={sess}"] if sess else []
 
-    # 为本次直播创建独立的存储文件夹（使用当前时间命名）
-    ts_dir = Path(save_dir) / now_str()
+    # 为本次直播创建独立的存储文件夹（使用当前时间和房间号命名，多房间同时开播也不冲突）
+    # 配置了 scratch_dir 时建在本地工作目录，处理完再搬到保存目录
+    ts_dir = work_dir() / f"{now_str()}_{real_rid}"
     ts_dir.mkdir(parents=True, exist_ok=True)
-    danmaku_file = ts_dir / "danmaku.ass"  # 弹幕文件路径
+    danmaku_db = ts_dir / "danmaku.db"     # 弹幕库，录制中实时写入
     start_time = datetime.now()
+    # 录制日志：记录分段和处理进度，进程中断后重启可以接着合并、压制
+    journal = SessionJournal.create(ts_dir, room=room.url, real_rid=real_rid, title=raw_title,
+                                    session_prefix=session_prefix, start_time=start_time.timestamp())
 
-    # 创建 stop_event
-    danmu_stop_event = threading.Event()  # 创建 stop_event
+    # 启动弹幕写库线程和弹幕监听任务（监听与其他房间共用同一个事件循环）
+    danmu_writer = DanmakuWriter(danmaku_db, {"room": real_rid, "title": raw_title, "start_time": start_time.timestamp()})
+    danmu_writer.start()
+    metrics.gauge("recorder_danmaku_queue_depth", danmu_writer.queue.qsize, room=real_rid)
+    metrics.gauge("recorder_danmaku_dropped", lambda: danmu_writer.dropped, room=real_rid)
+    metrics.gauge("recorder_danmaku_written", lambda: danmu_writer.written, room=real_rid)
+    danmu_stop_event = asyncio.Event()
+    danmu_task = asyncio.create_task(danmu_listener(real_rid, danmu_writer, start_time, danmu_stop_event, conn))
 
-    # 启动弹幕监听线程（守护线程，在后台记录弹幕）
-    thread = threading.Thread(
-        target=danmu_listener,
-        args=(real_rid, danmaku_file, start_time, danmu_stop_event),  # 传递正确的 stop_event
-        daemon=True
-    )
-    thread.start()
-
-    print(f"🟢 弹幕监听线程已启动，弹幕输出文件: {danmaku_file}")
+    print(f"🟢 弹幕监听任务已启动，弹幕库: {danmaku_db}")
 
     parts = []           # 保存本次所有录制的 ts 分段文件路径
+    segment_started = {}  # 分段 -> 收到第一块数据的时间（time.time()），用于把弹幕时间对齐到视频
+    merger = IncrementalMerger(ts_dir / "merged.ts", journal)  # 边录边合并，录制途中即可观看
+    print(f"🎞️ 已录制的分段会追加到 {merger.path}，录制途中可直接播放")
     last_data_time = time.time()  # 记录上次成功写入数据的时间，用于超时判断
+    last_segment_end = None       # 上一段最后写入的时间，用于统计分段之间的断档
 
     # 发送 Telegram 开始录制通知
-    send_tg_message(f"🟢 {session_prefix} 开始录制，时间：{now_str('%H:%M:%S')}")
+    await notify(f"🟢 {session_prefix} 开始录制，时间：{now_str('%H:%M:%S')}")
+
+    # 进程内拉流需要 aiohttp，不可用时仍用 streamlink
+    fetcher = NativeFetcher(real_rid) if stream_engine == "native" and WS_AVAILABLE else None
+
+    # 弹幕连接收到 PREPARING（主播下播）时不必等无数据超时，当前分段结束即停止；
+    # 当前分段结束前又收到 LIVE（主播很快重新开播）则继续录制
+    live_ended = asyncio.Event()
+    unsubscribe_stop = unsubscribe_live = None
+    if conn is not None:
+        unsubscribe_stop = conn.subscribe(("PREPARING",), lambda msgs: live_ended.set())
+        unsubscribe_live = conn.subscribe(("LIVE",), lambda msgs: live_ended.clear())
 
     # 循环录制，自动重连
-    while True:
-        # 为新的片段生成文件名（当前时间为文件名）
-        ts_filename = ts_dir / f"{now_str()}.ts"
-        # 调用 streamlink 获取直播流，保存到文件
-        cmd = ["streamlink"] + cookie_args + [
-            "--retry-streams", "5", "--retry-max", "3",  # 尝试获取流的重试次数
-            f"https://live.bilibili.com/{real_rid}", "best", "-o", str(ts_filename)
-        ]
-        for attempt in range(1, 4):
-            res = subprocess.run(cmd)
-            if res.returncode == 0:
-                break
+    try:
+        while True:
+            # 为新的片段生成文件名（当前时间为文件名）
+            ts_filename = ts_dir / f"{now_str()}.ts"
+            if fetcher is not None:
+                # 断线后立即重新解析地址续录；没拉到数据（未开播或地址失效）才稍等再试
+                # 续录可能在同一秒内发生，文件名精确到微秒避免覆盖上一段
+                ts_filename = await fetcher.fetch_segment(ts_dir / now_str("%Y%m%d_%H%M%S_%f")) or ts_filename
+                if not ts_filename.exists():
+                    await asyncio.sleep(1)
+                else:
+                    segment_started[ts_filename] = fetcher.first_byte_wall
             else:
-                send_tg_message(f"❌ 第{attempt}次拉流失败，错误码{res.returncode}")
-                if attempt < 3:
-                    time.sleep(5)
-        else:
-            send_tg_message("❌ 连续3次拉流失败，跳过本段")
+                # 调用 streamlink 获取直播流，保存到文件
+                cmd = ["streamlink"] + cookie_args + [
+                    "--retry-streams", "5", "--retry-max", "3",  # 尝试获取流的重试次数
+                    f"https://live.bilibili.com/{real_rid}", "best", "-o", str(ts_filename)
+                ]
+                first_byte = asyncio.create_task(wait_first_byte(ts_filename))
+                for attempt in range(1, 4):
+                    returncode = await run_cmd(cmd)
+                    metrics.inc("recorder_streamlink_exit_total", room=real_rid, code=returncode)
+                    if returncode == 0:
+                        break
+                    else:
+                        await notify(f"❌ 第{attempt}次拉流失败，错误码{returncode}")
+                        if attempt < 3:
+                            metrics.inc("recorder_streamlink_retries_total", room=real_rid)
+                            await asyncio.sleep(5)
+                else:
+                    await notify("❌ 连续3次拉流失败，跳过本段")
+                if first_byte.done():
+                    segment_started[ts_filename] = first_byte.result()
+                    if last_segment_end is not None:
+                        metrics.observe("recorder_segment_gap_seconds", first_byte.result() - last_segment_end,
+                                        room=real_rid)
+                first_byte.cancel()
 
-        # 只在文件有效且未被添加时 append
-        if ts_filename.exists() and ts_filename.stat().st_size > 1_048_576:  # >1MB视为有效片段
-            if ts_filename not in parts:
-                parts.append(ts_filename)
-            last_data_time = time.time()
+            if ts_filename.exists() and ts_filename not in parts:
+                st = ts_filename.stat()
+                last_segment_end = st.st_mtime
+                metrics.observe("recorder_segment_bytes", st.st_size, room=real_rid)
+            # 只在文件有效且未被添加时 append
+            if ts_filename.exists() and ts_filename.stat().st_size > 1_048_576:  # >1MB视为有效片段
+                if ts_filename not in parts:
+                    parts.append(ts_filename)
+                    journal.add_part(ts_filename, segment_started.get(ts_filename))
+                    merger.submit(ts_filename)
+                last_data_time = time.time()
 
-        # 若收到停止标志（来自外部下播通知），跳出循环结束录制
-        if stop_recording_flag:
-            break
-        # 若超过设定时间无有效数据，则认为直播已结束，下播
-        if time.time() - last_data_time > no_stream_timeout:
-            print("🛑 长时间无数据，判断主播已下播，结束录制。")
-            stop_recording_flag = True
-            break
+            # 若收到停止标志（来自外部下播通知），跳出循环结束录制
+            if live_ended.is_set():
+                print("🛑 弹幕连接收到下播通知，结束录制。")
+                stop_recording = True
+            if stop_recording:
+                break
+            # 若超过设定时间无有效数据，则认为直播已结束，下播
+            if time.time() - last_data_time > no_stream_timeout:
+                print("🛑 长时间无数据，判断主播已下播，结束录制。")
+                stop_recording = True
+                break
+    finally:
+        if fetcher is not None and fetcher.gaps:
+            print(f"⏱️ 共续录 {len(fetcher.gaps)} 次，平均断档 {sum(fetcher.gaps) / len(fetcher.gaps):.2f}s，"
+                  f"最长 {max(fetcher.gaps):.2f}s")
+        if conn is not None:
+            unsubscribe_stop()
+            unsubscribe_live()
+        danmu_stop_event.set()  # 停止弹幕监听（连接本身由调度器持有，继续用于开播检测）
+        await asyncio.gather(danmu_task, return_exceptions=True)
+        # 写完剩余弹幕再继续，合并转码要用到完整的弹幕文件
+        await asyncio.to_thread(danmu_writer.close)
+        for name in ("recorder_danmaku_queue_depth", "recorder_danmaku_dropped", "recorder_danmaku_written"):
+            metrics.remove_gauge(name, room=real_rid)
+        stats = danmu_writer.stats()
+        print(f"📝 弹幕写入 {stats['written']} 条，丢弃 {stats['dropped']} 条，延迟 {stats['delayed']} 条，"
+              f"写库失败 {stats['failed']} 条")
+
+    journal.mark("recording")
 
     # 录制结束，发送下播通知
-    send_tg_message(f"🔴 {session_prefix} 检测到下播，停止录制，时间：{now_str('%H:%M:%S')}")
-    danmu_stop_event.set()  # 停止弹幕监听
-
-    # 合并所有录制的 ts 文件
-    if parts:
-        # 1) 生成清单文件（去重）
-        unique_parts = []
-        seen = set()
-        for seg in parts:
-            if seg not in seen:
-                unique_parts.append(seg)
-                seen.add(seg)
-        list_file = ts_dir / "files.txt"
-        with open(list_file, "w", encoding="utf-8") as lf:
-            for seg in unique_parts:
-                lf.write(f"file '{seg.as_posix()}'\n")
-
-        # merged_ts 提前定义
-        merged_ts = Path(save_dir) / f"{session_prefix}{now_str()}_ts.ts"
-        def try_concat(retries=2):
-            cmd = [
-                "ffmpeg", "-y", "-f", "concat", "-safe", "0",
-                "-i", str(list_file), "-c", "copy", str(merged_ts)
-            ]
-            for i in range(1, retries+1):
-                res = subprocess.run(cmd)
-                if res.returncode == 0:
-                    send_tg_message(f"✅ 合并成功（第{i}次）")
-                    return True
-                else:
-                    send_tg_message(f"❌ 合并失败（第{i}次），错误码 {res.returncode}")
-                    if i < retries:
-                        time.sleep(5)
-            send_tg_message("❌ FFmpeg 合并最终失败")
-            return False
+    await notify(f"🔴 {session_prefix} 检测到下播，停止录制，时间：{now_str('%H:%M:%S')}")
+    finish_session(journal, merger)  # 合并、压制在后期处理队列中进行，房间立刻回到开播检测
 
-        # 3) 执行合并，失败就退出
-           # 3) 将弹幕嵌入到视频中
-        if not try_concat():
-            return  # 如果合并失败，则直接退出
-
-    # 4) 生成无弹幕版本的视频
-    no_danmu_video = Path(save_dir) / f"{session_prefix}{now_str()}_no_danmu.mp4"
-    cmd_no_danmu = [
-        "ffmpeg", "-i", str(merged_ts), "-c:v", "libx264", "-c:a", "aac", "-strict", "experimental", str(no_danmu_video)
-    ]
-    res_no_danmu = subprocess.run(cmd_no_danmu)
-    if res_no_danmu.returncode == 0:
-        send_tg_message(f"✅ 无弹幕视频生成成功：{no_danmu_video}")
+def finish_session(journal: SessionJournal, merger: IncrementalMerger = None):
+    """
+    把下播的录制交给后期处理队列后立即返回：合并 -> 转封装 -> 高光片段 -> 压制 -> 搬到保存目录。
+    每完成一步都记入录制日志，进程中断后重启时跳过已完成的步骤（merger 为空表示续处理）。
+    """
+    journal.update(attempts=journal.data["attempts"] + 1)
+    if merger is None and not journal.done("recording"):
+        recovered = journal.recover_parts()
+        if recovered:
+            print(f"♻️ 补回日志中缺少的 {len(recovered)} 个分段：{', '.join(p.name for p in recovered)}")
+        journal.mark("recording")
+    if not journal.parts():
+        journal.mark("postprocess")  # 没有有效片段，无需合并和转码，只搬运弹幕库
+        archive_session(journal)
+        return
+    get_postprocess_queue().submit(journal, merger)
+
+def archive_session(journal: SessionJournal):
+    """在工作目录中处理完的录制交给后台搬运，不在这里等待"""
+    if scratch_enabled() and journal.ts_dir.parent.resolve() != Path(save_dir).resolve():
+        get_archive_mover().submit(journal)
     else:
-        send_tg_message(f"❌ 无弹幕视频生成失败，错误码 {res_no_danmu.returncode}")
-    
-    
-    if danmaku_file.exists():
-        final_video = Path(save_dir) / f"{session_prefix}{now_str()}_with_danmu.mp4"
-        cmd_danmu = [
-            "ffmpeg", "-i", str(merged_ts), "-i", str(danmaku_file), "-c:v", "libx264", "-c:a", "aac",
-            "-c:s", "mov_text", "-strict", "experimental", str(final_video)
-        ]
-        res = subprocess.run(cmd_danmu)
-        if res.returncode == 0:
-            print(f"✅ 弹幕视频生成成功：{final_video}")
+        journal.mark("archive")
+
+def session_outputs(journal: SessionJournal):
+    """合并后的 TS、无弹幕、带弹幕三个输出文件（文件名首次确定后记入日志）"""
+    session_prefix = journal.data["session_prefix"]
+    return (journal.output("merged_ts", f"{session_prefix}{now_str()}_ts.ts"),
+            journal.output("no_danmu_video", f"{session_prefix}{now_str()}_no_danmu.mp4"),
+            journal.output("final_video", f"{session_prefix}{now_str()}_with_danmu.mp4"))
+
+async def merge_session(journal: SessionJournal, merger: IncrementalMerger = None) -> bool:
+    """合并分段并从弹幕库导出 ASS，跳过日志中已完成的步骤，成功时返回 True"""
+    data = journal.data
+    ts_dir = journal.ts_dir
+    parts = journal.parts()
+
+    # 1) 合并所有录制的 ts 文件
+    incremental = ts_dir / "merged.ts"
+    merged_ts, _, _ = session_outputs(journal)
+    if not journal.done("merge"):
+        if (merger is None and merged_ts.exists() and not incremental.exists() and data["merged"]
+                and not data.get("merge_failed")):
+            # 上次中断前已把增量合并结果移出录制文件夹
+            journal.mark("merge", incremental=True)
         else:
-            print(f"❌ 弹幕视频生成失败，错误码 {res.returncode}")
+            if merger is None:
+                merger = IncrementalMerger(incremental, journal)
+                merger.resume()
+            merged_ok = await merger.finish()  # 录制期间已增量合并，这里只需等最后一段
+            if merged_ok:
+                os.replace(merger.path, merged_ts)
+                await notify(f"✅ 合并成功（录制中已增量合并 {len(merger.merged)} 段）")
+            else:
+                merger.path.unlink(missing_ok=True)  # 丢弃不完整的增量合并结果
+                if not await concat_parts(parts, ts_dir, merged_ts):
+                    return False  # 如果合并失败，则直接退出
+            journal.mark("merge", incremental=merged_ok)
 
-    
+    # 弹幕时间按各分段在合并视频中的实际起点对齐（整体合并时只知道第一段的起点），再导出 ASS 用于压制
+    if not journal.done("danmaku"):
+        danmaku_file = ts_dir / "danmaku.ass"
+        started = {p["file"]: p["started"] for p in data["parts"]}
+        placed = [(m["file"], m["offset"]) for m in data["merged"]] if data["incremental"] else [(parts[0].name, 0.0)]
+        anchors = [(round((started[seg] - data["start_time"]) * 1000), round(offset * 1000))
+                   for seg, offset in placed if started.get(seg)]
+        count = await asyncio.to_thread(finalize_danmaku, ts_dir / "danmaku.db", danmaku_file, anchors)
+        print(f"📝 已从弹幕库导出 {count} 条弹幕：{danmaku_file}")
+        journal.mark("danmaku")
+    return True
 
-        
+async def encode_session(journal: SessionJournal, only: Path = None) -> bool:
+    """
+    生成两个 MP4 中尚未完成的（only 指定时只做这一个），已生成的输出不再重做；
+    两个都完成时记录 postprocess 步骤。全部成功时返回 True。
+    """
+    merged_ts, no_danmu_video, final_video = session_outputs(journal)
+    outputs = journal.data["outputs"]
+    skip = {name for name, ok in outputs.items() if ok}
+    if only is not None:
+        skip |= {no_danmu_video.name, final_video.name} - {only.name}
+    report = await postprocess(merged_ts, journal.ts_dir / "danmaku.ass", no_danmu_video, final_video, skip=skip)
+    outputs.update({name: r["ok"] for name, r in report.items()})
+    ok = all(r["ok"] for r in report.values())
+    if ok and only is None:
+        journal.mark("postprocess")
+    else:
+        journal.save()
+    return ok
 
+async def remux_session(journal: SessionJournal) -> bool:
+    """源编码可直接封装时先转封装出无弹幕版本（几分钟内可看）；不能时留给压制任务一次解码同时生成两个版本"""
+    merged_ts, no_danmu_video, _ = session_outputs(journal)
+    if journal.done("postprocess") or journal.data["outputs"].get(no_danmu_video.name):
+        return True
+    if not can_remux(*await probe_codecs(merged_ts)):
+        return True
+    return await encode_session(journal, only=no_danmu_video)
 
+async def highlight_session(journal: SessionJournal) -> bool:
+    """按弹幕突增切出高光片段"""
+    if not journal.done("highlights"):
+        merged_ts, _, _ = session_outputs(journal)
+        clips = await cut_highlights(journal, merged_ts, highlight_clips) if highlight_clips > 0 else []
+        journal.mark("highlights", highlights=clips)
+    return True
 
-if __name__ == "__main__":
+async def compress_session(journal: SessionJournal) -> bool:
+    """压制带弹幕版本（以及没能转封装的无弹幕版本）"""
+    return journal.done("postprocess") or await encode_session(journal)
+
+async def concat_parts(parts: list, ts_dir: Path, merged_ts: Path) -> bool:
+    """增量合并失败时的后备方案：用 concat 清单把所有分段整体合并"""
+    # 1) 生成清单文件（去重）
+    unique_parts = []
+    seen = set()
+    for seg in parts:
+        if seg not in seen:
+            unique_parts.append(seg)
+            seen.add(seg)
+    list_file = ts_dir / "files.txt"
+    with open(list_file, "w", encoding="utf-8") as lf:
+        for seg in unique_parts:
+            lf.write(f"file '{seg.as_posix()}'\n")
+
+    # 先写到临时文件，成功后再改名，中途退出留下的半个文件不会被续处理当成合并结果
+    tmp = merged_ts.with_name(merged_ts.name + ".tmp")
+
+    async def try_concat(retries=2):
+        cmd = [
+            "ffmpeg", "-y", "-f", "concat", "-safe", "0",
+            "-i", str(list_file), "-c", "copy", "-f", "mpegts", str(tmp)
+        ]
+        for i in range(1, retries+1):
+            started = time.monotonic()
+            returncode = await run_cmd(cmd)
+            metrics.observe("recorder_ffmpeg_phase_seconds", time.monotonic() - started, phase="concat")
+            if returncode == 0:
+                os.replace(tmp, merged_ts)
+                await notify(f"✅ 合并成功（第{i}次）")
+                return True
+            else:
+                await notify(f"❌ 合并失败（第{i}次），错误码 {returncode}")
+                if i < retries:
+                    await asyncio.sleep(5)
+        await notify("❌ FFmpeg 合并最终失败")
+        tmp.unlink(missing_ok=True)
+        return False
+
+    # 2) 执行合并
+    return await try_concat()
+
+# ========== 高光检测 ==========
+def load_danmaku_times(db_path: Path, cmds=("DANMU_MSG",)) -> "np.ndarray":
+    """读出弹幕库中所有弹幕的视频时间（秒，已按分段对齐），返回 float64 数组（不排序，按秒分桶计数用不到顺序）"""
+    store = DanmakuStore(db_path)
+    try:
+        rows = store.db.execute(f"SELECT ts_ms FROM danmaku WHERE cmd IN ({','.join('?' * len(cmds))})", cmds)
+        ms = np.fromiter((row[0] for row in rows), dtype=np.float64)
+        return store.timeline().to_video_array(ms) / 1000
+    finally:
+        store.close()
+
+def burst_scores(times: "np.ndarray", window: float, baseline: float):
+    """
+    弹幕速率与突增得分（全部向量化）：按秒分桶计数，前缀和求出以每一秒为起点、window 秒内的速率，
+    再用前缀和求前后 baseline 秒内速率的均值和方差（w 为取整后的 window）：
+    得分 = (速率 - 均值) / sqrt(方差 + (均值 + 1/w) / w)，
+    分母里的 均值 / w 是按泊松分布估计的计数噪声，1/w² 是下限：前后完全没有弹幕时，窗口内每多一条弹幕得分最多加 1，
+    弹幕稀少时零星几条不会得高分。
+    返回 (速率（条/秒）, 得分)，下标为窗口起点（秒）。
+    """
+    counts = np.bincount(np.maximum(times, 0).astype(np.int64))
+    w = max(1, int(round(window)))
+    if len(counts) < w:
+        counts = np.pad(counts, (0, w - len(counts)))
+    total = np.concatenate(([0], np.cumsum(counts)))
+    rate = (total[w:] - total[:-w]) / w
+    half = max(w, int(round(baseline))) // 2
+    s1 = np.concatenate(([0.0], np.cumsum(rate)))
+    s2 = np.concatenate(([0.0], np.cumsum(rate * rate)))
+    pos = np.arange(len(rate))
+    lo = np.maximum(pos - half, 0)
+    hi = np.minimum(pos + half + 1, len(rate))
+    n = hi - lo
+    mean = (s1[hi] - s1[lo]) / n
+    var = np.maximum((s2[hi] - s2[lo]) / n - mean * mean, 0)
+    return rate, (rate - mean) / np.sqrt(var + (mean + 1 / w) / w)
+
+def pick_peaks(score: "np.ndarray", count: int, separation: int, min_score: float = 0) -> list:
+    """依次取得分最高的位置，并屏蔽其前后 separation 内的位置，最多取 count 个得分高于 min_score 的峰"""
+    score = score.astype(np.float64)
+    peaks = []
+    while len(peaks) < count and len(score):
+        i = int(np.argmax(score))
+        if not score[i] > min_score:
+            break
+        peaks.append(i)
+        score[max(0, i - separation):i + separation + 1] = -np.inf
+    return peaks
+
+def find_highlights(db_path: Path, count: int, duration: float = None) -> list:
+    """在一场录制的弹幕中找出弹幕突增最明显的 count 段，按时间排序返回 [{"start", "end", "rate", "score"}]"""
+    times = load_danmaku_times(db_path)
+    if duration is not None:
+        times = times[times < duration]
+    if not len(times):
+        return []
+    rate, score = burst_scores(times, highlight_window, highlight_baseline)
+    peaks = pick_peaks(score, count, int(highlight_separation), highlight_min_score)
+    return sorted(({"start": float(i), "end": float(i + highlight_window), "rate": round(float(rate[i]), 2),
+                    "score": round(float(score[i]), 2)} for i in peaks), key=lambda h: h["start"])
+
+async def cut_highlights(journal: SessionJournal, merged_ts: Path, count: int) -> list:
+    """按弹幕突增从合并后的 TS 中切出高光片段（-c copy 不重新编码，起点落在关键帧上），返回片段信息"""
+    if np is None:
+        print("⚠️ 未安装 numpy，跳过高光检测")
+        return []
+    started = time.monotonic()
+    duration = await probe_duration(merged_ts)
+    found = await asyncio.to_thread(find_highlights, journal.ts_dir / "danmaku.db", count, duration)
+    print(f"✨ 高光检测用时 {time.monotonic() - started:.2f}s，找到 {len(found)} 段")
+    mp4 = can_remux(*await probe_codecs(merged_ts))
+    for k, h in enumerate(found, 1):
+        start = max(0.0, h["start"] - highlight_lead)
+        end = h["end"] if duration is None else min(h["end"], duration)
+        mark = f"{int(start) // 3600:02d}-{int(start) % 3600 // 60:02d}-{int(start) % 60:02d}"
+        clip = journal.output(f"highlight_{k}", f"{journal.data['session_prefix']}高光{k}_{mark}.{'mp4' if mp4 else 'ts'}")
+        returncode, _ = await run_ffmpeg([
+            "-ss", f"{start:.3f}", "-i", str(merged_ts), "-t", f"{end - start:.3f}",
+            "-map", "0:v", "-map", "0:a?", "-c", "copy", *(["-movflags", "+faststart"] if mp4 else []), str(clip)
+        ], phase="highlight_clip")
+        h.update(file=clip.name, ok=returncode == 0)
+        print(f"{'✂️' if returncode == 0 else '❌'} 高光{k} {ass_time(start)} ~ {ass_time(end)}，"
+              f"{h['rate']} 条/秒，得分 {h['score']}：{clip.name}")
+    if found:
+        await notify(f"✨ {journal.data['session_prefix']} 切出 {sum(h['ok'] for h in found)} 段高光片段")
+    return found
+
+# ========== 分层存储 ==========
+MOVE_CHUNK = 4 * 1024 * 1024  # 搬运时每次读写的字节数
+GB = 1024 ** 3
+
+def scratch_enabled() -> bool:
+    """是否启用了本地工作目录；与保存目录是同一个目录（写法不同也算）时视为未启用"""
+    return bool(scratch_dir) and Path(scratch_dir).resolve() != Path(save_dir).resolve()
+
+def work_dir() -> Path:
+    """录制和处理所在的目录：配置了 scratch_dir 时为本地工作目录，否则直接是保存目录"""
+    return Path(scratch_dir) if scratch_enabled() else Path(save_dir)
+
+class ArchiveMover:
+    """
+    后台搬运：把工作目录中处理完的录制（录制文件夹和保存目录下的输出文件）搬到保存目录。
+    单线程顺序搬运、令牌桶限速，写完重读校验 sha256 才算搬完，录制和压制不会等待慢速的目标盘；
+    已搬走的录制按容量从旧到新清理。
+    """
+
+    def __init__(self, scratch: Path, dest: Path):
+        self.scratch = scratch
+        self.dest = dest
+        self.bucket = TokenBucket(move_rate_limit * 1024 * 1024, MOVE_CHUNK) if move_rate_limit > 0 else None
+        self.queue = asyncio.Queue()
+        self.stopping = threading.Event()
+        self.task = None
+
+    def start(self) -> "ArchiveMover":
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self
+
+    def submit(self, journal: SessionJournal):
+        """提交一场处理完的录制，由后台按顺序搬运"""
+        self.start().queue.put_nowait(journal)
+
+    async def run(self):
+        try:
+            await asyncio.to_thread(self.evict)
+            while True:
+                try:
+                    journal = await asyncio.wait_for(self.queue.get(), timeout=60)
+                except asyncio.TimeoutError:
+                    await asyncio.to_thread(self.evict)  # 空闲时也检查磁盘余量
+                    continue
+                try:
+                    await asyncio.to_thread(self.archive, journal)
+                except OSError as e:
+                    print(f"❌ 搬运失败 [{journal.ts_dir}]: {e}，稍后重试")
+                    await notify(f"❌ 搬运到保存目录失败：{journal.ts_dir.name}，稍后重试")
+                    await asyncio.sleep(60)
+                    self.queue.put_nowait(journal)
+                    continue
+                await asyncio.to_thread(self.evict)
+        finally:
+            self.stopping.set()  # 让正在搬运的线程尽快退出
+
+    def throttle(self, amount: int):
+        if self.bucket is not None:
+            time.sleep(self.bucket.reserve(amount))
+
+    def file_sha256(self, path: Path) -> str:
+        digest = hashlib.sha256()
+        with path.open("rb") as f:
+            while chunk := f.read(MOVE_CHUNK):
+                self.throttle(len(chunk))
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def copy_verified(self, src: Path, dst: Path) -> str:
+        """限速复制到 dst 旁的临时文件，落盘后重新读出比对 sha256，一致才改成正式文件名，返回 sha256"""
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(dst.name + ".part")
+        digest = hashlib.sha256()
+        with src.open("rb") as fin, tmp.open("wb") as fout:
+            while chunk := fin.read(MOVE_CHUNK):
+                if self.stopping.is_set():
+                    raise OSError("搬运已中止")
+                self.throttle(len(chunk))
+                digest.update(chunk)
+                fout.write(chunk)
+                metrics.inc("recorder_archive_bytes_total", len(chunk))
+            fout.flush()
+            os.fsync(fout.fileno())
+        if self.file_sha256(tmp) != digest.hexdigest():
+            tmp.unlink(missing_ok=True)
+            metrics.inc("recorder_archive_verify_failures_total")
+            raise OSError(f"sha256 校验不一致：{dst}")
+        os.replace(tmp, dst)
+        return digest.hexdigest()
+
+    def session_files(self, journal: SessionJournal) -> list:
+        """一场录制在工作目录中的所有文件 [(路径, 相对保存目录的路径)]，录制日志除外"""
+        files = [(p, Path(journal.ts_dir.name) / p.relative_to(journal.ts_dir))
+                 for p in sorted(journal.ts_dir.rglob("*"))
+                 if p.is_file() and p.name != journal.path.name and not p.name.endswith((".tmp", ".part"))]
+        for name in journal.data["files"].values():
+            if (journal.ts_dir.parent / name).exists():
+                files.append((journal.ts_dir.parent / name, Path(name)))
+        return files
+
+    def archive(self, journal: SessionJournal):
+        """搬运一场录制；已校验过且目标大小一致的文件跳过，中断后可接着搬"""
+        started = time.monotonic()
+        archived = journal.data.setdefault("archived", {})
+        files = self.session_files(journal)
+        moved = 0
+        for src, rel in files:
+            dst = self.dest / rel
+            size = src.stat().st_size
+            if rel.as_posix() in archived and dst.exists() and dst.stat().st_size == size:
+                continue
+            archived[rel.as_posix()] = self.copy_verified(src, dst)
+            journal.save()
+            moved += size
+        journal.mark("archive")
+        # 日志最后写入，保存目录里出现 session.json 即表示整场已完整搬到
+        write_text_atomic(self.dest / journal.ts_dir.name / journal.path.name, journal.path.read_text(encoding="utf-8"))
+        elapsed = time.monotonic() - started
+        metrics.observe("recorder_archive_seconds", elapsed)
+        print(f"📦 已搬到保存目录：{journal.ts_dir.name}，{len(files)} 个文件，{moved / 1024 ** 2:.1f} MB，"
+              f"用时 {elapsed:.1f}s")
+
+    def evict(self):
+        """已搬走的录制超出保留上限或磁盘余量不足时，从最早搬走的开始删除工作目录中的副本"""
+        archived = []
+        for path in self.scratch.glob("*/session.json"):
+            try:
+                journal = SessionJournal.load(path)
+            except (OSError, ValueError):
+                continue
+            # 只清理保存目录里确实有完整副本的录制（保存目录的日志存在且不是同一个文件）
+            copy = self.dest / journal.ts_dir.name / path.name
+            if journal.finished and copy.exists() and not copy.samefile(path):
+                size = sum(src.stat().st_size for src, _ in self.session_files(journal)) + path.stat().st_size
+                archived.append((journal.data["stages"]["archive"], size, journal))
+        archived.sort(key=lambda item: item[0])
+        kept = sum(size for _, size, _ in archived)
+        free = shutil.disk_usage(self.scratch).free
+        while archived and (kept > scratch_keep_gb * GB or free < scratch_min_free_gb * GB):
+            _, size, journal = archived.pop(0)
+            for name in journal.data["files"].values():
+                (journal.ts_dir.parent / name).unlink(missing_ok=True)
+            shutil.rmtree(journal.ts_dir, ignore_errors=True)
+            kept -= size
+            free += size
+            print(f"🧹 已清理工作目录中搬走的录制：{journal.ts_dir.name}（{size / GB:.2f} GB）")
+
+_archive_mover = None
+
+def get_archive_mover() -> ArchiveMover:
+    """获取（必要时创建）全局共享的后台搬运器"""
+    global _archive_mover
+    if _archive_mover is None:
+        _archive_mover = ArchiveMover(work_dir(), Path(save_dir))
+        metrics.gauge("recorder_archive_queue_depth", _archive_mover.queue.qsize)
+    return _archive_mover
+
+# ========== 后期处理队列 ==========
+# 每场录制依次经过的处理步骤：步骤 -> (任务类别, 优先级, 处理函数)。
+# 优先级数字小的先做：合并、转封装、切高光片段几分钟内完成，排在动辄数小时的压制之前
+POSTPROCESS_PHASES = {
+    "merge": ("io", 0, merge_session),
+    "remux": ("io", 1, remux_session),
+    "highlights": ("io", 2, highlight_session),
+    "compress": ("cpu", 3, compress_session),
+}
+
+class PostprocessQueue:
+    """
+    后期处理队列：录制结束的场次按步骤拆成任务，分为压制（cpu）和合并、转封装、切片（io）两类，
+    各自有优先级队列和固定数量的 worker，从而分别限制同时进行的数量；
+    一步完成后再把同一场的下一步排进队列，全部完成后交给后台搬运。录制循环只负责提交，不等待处理。
+    某一步失败时隔一段时间重排该步，重试间隔逐次翻倍，总次数（含重启后的续处理）达到 MAX_ATTEMPTS 后放弃。
+    """
+    RETRY_DELAY = 60  # 第一次重试前等待的秒数
+
+    def __init__(self, cpu_workers: int, io_workers: int):
+        self.workers = {"cpu": max(1, cpu_workers), "io": max(1, io_workers)}
+        self.queues = {kind: asyncio.PriorityQueue() for kind in self.workers}
+        self.seq = 0  # 同优先级按提交顺序处理
+        self.tasks = []
+
+    def start(self) -> "PostprocessQueue":
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.worker(kind))
+                          for kind, count in self.workers.items() for _ in range(count)]
+        return self
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.queues.values())
+
+    def submit(self, journal: SessionJournal, merger: IncrementalMerger = None):
+        """提交一场下播的录制，从第一步开始处理（已完成的步骤在处理函数中跳过）"""
+        print(f"📥 {journal.ts_dir.name} 已加入后期处理队列，前面还有 {self.pending()} 个任务")
+        self.put(journal, merger, tuple(POSTPROCESS_PHASES))
+
+    def put(self, journal: SessionJournal, merger, phases: tuple):
+        kind, priority, _ = POSTPROCESS_PHASES[phases[0]]
+        self.seq += 1
+        self.start().queues[kind].put_nowait((priority, self.seq, time.monotonic(), journal, merger, phases))
+
+    async def worker(self, kind: str):
+        queue = self.queues[kind]
+        while True:
+            _, _, queued_at, journal, merger, phases = await queue.get()
+            phase = phases[0]
+            metrics.observe("recorder_postprocess_wait_seconds", time.monotonic() - queued_at, phase=phase)
+            started = time.monotonic()
+            run = POSTPROCESS_PHASES[phase][2]
+            try:
+                ok = await (run(journal, merger) if phase == "merge" else run(journal))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❗ 后期处理异常 [{journal.ts_dir.name}] {phase}: {e}")
+                ok = False
+            metrics.observe("recorder_postprocess_seconds", time.monotonic() - started, phase=phase)
+            if not ok:
+                await self.retry(journal, phases)
+            elif len(phases) > 1:
+                self.put(journal, None, phases[1:])
+            else:
+                archive_session(journal)
+
+    async def retry(self, journal: SessionJournal, phases: tuple):
+        """失败的步骤稍后重排；次数用尽时发通知，并照常搬到保存目录，不让失败的场次一直占着工作目录"""
+        phase, attempts = phases[0], journal.data["attempts"]
+        if attempts < SessionJournal.MAX_ATTEMPTS:
+            delay = self.RETRY_DELAY * 2 ** (attempts - 1)
+            journal.update(attempts=attempts + 1)
+            print(f"⚠️ {journal.ts_dir.name} 的 {phase} 步骤未完成，{delay}s 后重试（第 {attempts} 次失败）")
+            asyncio.get_running_loop().call_later(delay, self.put, journal, None, phases)
+            return
+        journal.update(failed=phase)
+        print(f"❌ {journal.ts_dir.name} 的 {phase} 步骤失败 {attempts} 次，放弃自动处理")
+        await notify(f"❌ {journal.ts_dir.name} 的 {phase} 步骤失败 {attempts} 次，已放弃自动处理，"
+                     f"录制文件原样保留在保存目录，请手动处理")
+        archive_session(journal)
+
+_postprocess_queue = None
+
+def get_postprocess_queue() -> PostprocessQueue:
+    """获取（必要时创建）全局共享的后期处理队列"""
+    global _postprocess_queue
+    if _postprocess_queue is None:
+        _postprocess_queue = PostprocessQueue(postprocess_cpu_workers, postprocess_io_workers)
+        for kind, q in _postprocess_queue.queues.items():
+            metrics.gauge("recorder_postprocess_queue_depth", q.qsize, kind=kind)
+    return _postprocess_queue
+
+# ========== 多房间调度 ==========
+def load_rooms(urls: list, path: str) -> list:
+    """从命令行参数和房间列表文件读取要监控的房间，都为空时使用 room_url"""
+    rooms = [Room(url, prefix) for url in urls]
+    if path:
+        for line in Path(path).read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue  # 跳过空行和注释
+            fields = line.split(maxsplit=1)
+            rooms.append(Room(fields[0], fields[1] if len(fields) > 1 else prefix))
+    if not rooms:
+        rooms.append(Room(room_url, prefix))
+    return rooms
+
+async def watch_room(room: Room, slots: asyncio.Semaphore):
+    """单个房间的主循环：等待开播 -> 录制 -> 结束后继续等待下一次开播"""
     # 提取真实房间号（处理短号情况）
-    room_id_str = room_url.rstrip("/").split("/")[-1]
-    real_rid = get_real_room_id(room_id_str)
+    room.real_rid = await asyncio.to_thread(get_real_room_id, room.room_id)
+    # 整个监控期间保持一条弹幕连接，开播检测、弹幕录制、下播检测共用
+    conn = RoomEventConnection(room.real_rid).start() if WS_AVAILABLE else None
+    try:
+        while True:
+            try:
+                if await wait_for_live(room, conn):
+                    # 记录开播时间，供轮询调度器推测常规开播时段
+                    await get_live_poller().history.add(room.real_rid, time.time())
+                    if slots.locked():
+                        print(f"⏳ 同时录制数已达上限 {max_concurrent_recordings}，{room.url} 排队等待")
+                    async with slots:
+                        await record_stream(room, conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❗ 主循环异常 [{room.url}]: {e}")
+            # 等待一段时间再进行下一轮检测，防止过于频繁
+            await asyncio.sleep(check_interval)
+    finally:
+        if conn is not None:
+            await conn.close()
 
-    # 主循环：等待开播 -> 录制 -> 结束后继续等待下一次开播
-    while True:
+def find_unfinished_sessions(root: Path) -> list:
+    """保存目录下录制日志显示还没处理完的录制（续处理失败次数过多的除外）"""
+    journals = []
+    for path in sorted(root.glob("*/session.json")):
         try:
-            if wait_for_live(real_rid):
-                record_stream(real_rid)
-        except Exception as e:
-            print(f"❗ 主循环异常: {e}")
-        # 等待一段时间再进行下一轮检测，防止过于频繁
-        time.sleep(check_interval)
+            journal = SessionJournal.load(path)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 录制日志读取失败 {path}: {e}")
+            continue
+        if not journal.finished and journal.data["attempts"] < SessionJournal.MAX_ATTEMPTS:
+            journals.append(journal)
+    return journals
+
+async def run_supervisor(rooms: list):
+    """在同一个事件循环中监控所有房间，并限制同时录制的数量；启动时续处理上次遗留的录制"""
+    slots = asyncio.Semaphore(max_concurrent_recordings)
+    # 先于房间监控扫描，避免把本次新开始的录制当成遗留；工作目录和保存目录都可能有遗留
+    roots = {work_dir().resolve(), Path(save_dir).resolve()}
+    leftovers = [j for root in sorted(roots) for j in find_unfinished_sessions(root)] if resume_on_start else []
+    print(f"👀 开始监控 {len(rooms)} 个直播间，最多同时录制 {max_concurrent_recordings} 个")
+    monitor = asyncio.create_task(serve_metrics())
+    if scratch_enabled():
+        print(f"💾 录制先写入工作目录 {scratch_dir}，处理完后台搬到 {save_dir}")
+        get_archive_mover().start()  # 启动时先清理一次工作目录
+    if leftovers:
+        print(f"♻️ 发现 {len(leftovers)} 场未处理完的录制，加入后期处理队列")
+    for journal in leftovers:
+        print(f"♻️ 续处理：{journal.ts_dir}（已完成 {', '.join(journal.data['stages']) or '无'}）")
+        finish_session(journal)
+    try:
+        await asyncio.gather(*(watch_room(room, slots) for room in rooms))
+    finally:
+        tasks = [monitor]
+        if _postprocess_queue is not None:
+            tasks.extend(_postprocess_queue.tasks)
+        if _archive_mover is not None and _archive_mover.task is not None:
+            tasks.append(_archive_mover.task)
+        for task in tasks:
+            task.cancel()  # 正在运行的 ffmpeg 随之终止，下次启动时按录制日志续处理
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await close_http_session()
+
+def parse_args(argv=None):
+    """解析命令行参数，未指定的选项沿用脚本顶部的用户配置"""
+    parser = argparse.ArgumentParser(description="B站直播多房间录制")
+    parser.add_argument("rooms", nargs="*", help="直播间 URL 或 房间号，可填多个")
+    parser.add_argument("-f", "--rooms-file", default=rooms_file, help="房间列表文件，每行：直播间URL或房间号 [文件名前缀]")
+    parser.add_argument("-n", "--max-recordings", type=int, default=max_concurrent_recordings, help="同时录制数上限")
+    parser.add_argument("-o", "--save-dir", default=save_dir, help="录播文件保存目录")
+    parser.add_argument("--scratch-dir", default=scratch_dir, help="本地工作目录，录制和处理在这里进行，完成后后台搬到保存目录")
+    parser.add_argument("--metrics-port", type=int, default=metrics_port, help="运行指标 HTTP 端口，0 表示不开启")
+    parser.add_argument("--profile", action="store_true", default=profile_hot_paths, help="采样分析弹幕接收、解析热点")
+    parser.add_argument("--no-resume", action="store_true", default=not resume_on_start, help="启动时不续处理上次未处理完的录制")
+    parser.add_argument("--cpu-workers", type=int, default=postprocess_cpu_workers, help="同时进行的压制任务数")
+    parser.add_argument("--io-workers", type=int, default=postprocess_io_workers, help="同时进行的合并、转封装、切片任务数")
+    parser.add_argument("--export", metavar="DB", help="从弹幕库（录制文件夹下的 danmaku.db）导出弹幕后退出")
+    parser.add_argument("--format", choices=("ass", "json", "xml"), default="ass", help="导出格式")
+    parser.add_argument("--range", nargs=2, type=float, metavar=("START", "END"), help="只导出视频时间 START~END 秒，时间从 0 开始")
+    parser.add_argument("--export-to", metavar="FILE", help="导出文件路径，默认与弹幕库同名")
+    parser.add_argument("--search", metavar="KEYWORD", help="在保存目录下所有录制的弹幕库中搜索弹幕后退出")
+    parser.add_argument("--uid", type=int, help="搜索时只看该用户的弹幕")
+    parser.add_argument("--highlights", metavar="DIR", help="对一场录制（录制文件夹）做高光检测并切出片段后退出")
+    parser.add_argument("--clips", type=int, default=highlight_clips or 5, help="切出的高光片段数")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    save_dir = args.save_dir
+    scratch_dir = args.scratch_dir
+    max_concurrent_recordings = max(1, args.max_recordings)
+    metrics_port = args.metrics_port
+    profile_hot_paths = args.profile
+    resume_on_start = not args.no_resume
+    postprocess_cpu_workers = args.cpu_workers
+    postprocess_io_workers = args.io_workers
+    if args.export:
+        db = Path(args.export)
+        out = Path(args.export_to) if args.export_to else db.with_suffix(f".{args.format}")
+        start, end = args.range or (0, None)
+        print(f"📝 已导出 {export_danmaku(db, out, args.format, start, end)} 条弹幕：{out}")
+        sys.exit(0)
+    if args.search:
+        for session, sec, uname, text in search_danmaku(args.search, uid=args.uid):
+            print(f"{session}  {ass_time(sec)}  {uname}: {text}")
+        sys.exit(0)
+    if args.highlights:
+        try:
+            journal = SessionJournal.load(Path(args.highlights) / "session.json")
+        except (OSError, ValueError) as e:
+            print(f"❌ 读取录制日志失败：{e}")
+            sys.exit(1)
+        merged_name = journal.data["files"].get("merged_ts")
+        merged = journal.ts_dir.parent / merged_name if merged_name else None
+        if not journal.done("merge") or merged is None or not merged.exists():
+            print(f"❌ 这场录制还没有合并好的视频（{merged or '未合并'}），等后期处理完成合并后再切高光片段")
+            sys.exit(1)
+        asyncio.run(cut_highlights(journal, merged, args.clips))
+        sys.exit(0)
+    # 确保保存目录（和工作目录）存在
+    Path(save_dir).mkdir(parents=True, exist_ok=True)
+    work_dir().mkdir(parents=True, exist_ok=True)
+    try:
+        asyncio.run(run_supervisor(load_rooms(args.rooms, args.rooms_file)))
+    except KeyboardInterrupt:
+        print("👋 已退出")